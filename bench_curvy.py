@@ -0,0 +1,371 @@
+""" Benchmarks for the curvy pipeline.
+
+Usage: python bench_curvy.py [-r repeat] [-w warmup] [-o file] [--slots] [--adaptive]
+       [--no-superinstructions] [--engine loop|closure] [--jit] [--licm] [--cse]
+       [--deep terms] [--profile interval] [workload ...]
+
+Times each stage of `curvy.main` separately (ast.parse, Optimizer, Compiler.visit,
+Compiler.build and VirtualMachine.run) on every workload, along with CPython compiling
+and exec'ing the same source as a baseline. Each Optimizer pass is timed too.
+The results are printed as JSON.
+With --deep, the Optimizer and Compiler are also timed on an `a + a + ...` expression
+with that many terms, nested too deep for the stdlib parser.
+With --profile, workloads run under a `curvy.Profiler` sampling at that interval, to
+measure its overhead against a run without it.
+"""
+import argparse
+import ast
+from collections import defaultdict
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+
+from curvy import Compiler, Optimizer, Profiler, VirtualMachine
+
+LARGE_LIST = list(range(1000))
+
+WORKLOADS = {
+    # The loop workloads from `test_curvy.py`, scaled up
+    "while": """a = 10000
+while a:
+    a -= 1
+""",
+    "for": """b = 0
+for x in range(10000):
+    b += x
+""",
+    # Arithmetic-heavy loop
+    "arithmetic": """a = 5000
+t = 0
+while a:
+    t = (t + a * 3 - 1) % 1000003
+    t = t ^ (a << 2) // 7
+    a -= 1
+""",
+    # Large literals, like `test_extended_arg`
+    "literals": f"""a = {LARGE_LIST}
+b = {dict(zip(LARGE_LIST, LARGE_LIST))}
+c = {set(LARGE_LIST)}
+a[999] + b[999]
+""",
+    # Nested if/while
+    "nested": """a = 200
+b = 0
+while a:
+    c = 20
+    while c:
+        if c % 2:
+            b += c
+        else:
+            b -= 1
+        c -= 1
+    a -= 1
+""",
+    # Builtin calls in a loop
+    "calls": """a = 0
+for x in range(5000):
+    a = max(a, abs(x - 2500), 5)
+    b = len([x, a])
+""",
+    # Comparisons and `and`/`or` in tests
+    "compare": """i = 0
+n = 10000
+t = 0
+while i < n:
+    if i % 3 == 0 or i % 5 == 0 and not i > 5000:
+        t += i
+    i += 1
+""",
+    # Arithmetic on names the loop doesn't change, for --licm and --cse
+    "invariant": """n = 7
+k = 3
+a = 5000
+t = 0
+while a:
+    t = (t + a * (n * 4 + k) + (n * 4 + k) * (n - k)) % 1000003
+    a -= 1
+""",
+}
+
+STAGES = ("parse", "optimize", "compile", "build", "run")
+
+
+def summarize(samples):
+    """ Return statistics in seconds for a list of timings """
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def time_stages(
+    source, repeat, warmup, compiler_options, vm_options, optimizer_options=None, profile=None
+):
+    """ Time each stage of the curvy pipeline, and each Optimizer pass, on `source`.
+    Each stage gets fresh input every repetition, since the Optimizer changes
+    the tree in place and `Compiler.build` consumes the instruction list.
+    With `profile`, the run stage is sampled every `profile` seconds.
+    """
+    samples = {stage: [] for stage in STAGES}
+    passes = defaultdict(list)
+    clock = time.perf_counter
+    for x in range(warmup + repeat):
+        start = clock()
+        tree = ast.parse(source)
+        parsed = clock()
+        optimizer = Optimizer(**(optimizer_options or {}))
+        tree = optimizer.optimize(tree)
+        optimized = clock()
+        compiler = Compiler(**compiler_options)
+        compiler.visit([tree])
+        compiled = clock()
+        bytecode = compiler.build()
+        built = clock()
+        vm = VirtualMachine(**vm_options)
+        profiler = Profiler(vm, profile) if profile else contextlib.nullcontext()
+        with contextlib.redirect_stdout(io.StringIO()), profiler:
+            run_start = clock()
+            vm.run(bytecode)
+            ran = clock()
+
+        if x < warmup:
+            continue
+        samples["parse"].append(parsed - start)
+        samples["optimize"].append(optimized - parsed)
+        samples["compile"].append(compiled - optimized)
+        samples["build"].append(built - compiled)
+        samples["run"].append(ran - run_start)
+        for name, seconds in optimizer.timings.items():
+            passes[name].append(seconds)
+
+    return (
+        {stage: summarize(times) for stage, times in samples.items()},
+        {name: summarize(times) for name, times in passes.items()},
+        bytecode,
+    )
+
+
+def time_cpython(source, repeat, warmup):
+    """ Time CPython compiling and exec'ing `source`, as a baseline """
+    samples = {"compile": [], "exec": []}
+    clock = time.perf_counter
+    for x in range(warmup + repeat):
+        start = clock()
+        code = compile(source, "<bench>", "exec")
+        compiled = clock()
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec_start = clock()
+            exec(code, {})
+            ran = clock()
+
+        if x < warmup:
+            continue
+        samples["compile"].append(compiled - start)
+        samples["exec"].append(ran - exec_start)
+
+    return {stage: summarize(times) for stage, times in samples.items()}
+
+
+def deep_expression(terms):
+    """ Return a module tree setting `a` and printing `a + a + ...` with `terms` terms.
+    It is built directly, since `ast.parse` can't parse an expression nested this deep.
+    """
+    expr = ast.Name("a", ast.Load())
+    for x in range(terms - 1):
+        expr = ast.BinOp(expr, ast.Add(), ast.Name("a", ast.Load()))
+    return ast.Module(
+        [ast.Assign([ast.Name("a", ast.Store())], ast.Constant(1)), ast.Expr(expr)], []
+    )
+
+
+def time_deep(terms, repeat, warmup, compiler_options, vm_options, optimizer_options=None):
+    """ Time the optimize, compile, build and run stages on `deep_expression(terms)` """
+    samples = {stage: [] for stage in STAGES[1:]}
+    clock = time.perf_counter
+    for x in range(warmup + repeat):
+        tree = deep_expression(terms)
+        start = clock()
+        tree = Optimizer(**(optimizer_options or {})).optimize(tree)
+        optimized = clock()
+        compiler = Compiler(**compiler_options)
+        compiler.visit([tree])
+        compiled = clock()
+        bytecode = compiler.build()
+        built = clock()
+        vm = VirtualMachine(**vm_options)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_start = clock()
+            vm.run(bytecode)
+            ran = clock()
+
+        if x < warmup:
+            continue
+        samples["optimize"].append(optimized - start)
+        samples["compile"].append(compiled - optimized)
+        samples["build"].append(built - compiled)
+        samples["run"].append(ran - run_start)
+
+    stages = {stage: summarize(times) for stage, times in samples.items()}
+    return {
+        "terms": terms,
+        "stages": stages,
+        "total": sum(stats["min"] for stats in stages.values()),
+    }
+
+
+def count_instructions(bytecode, vm_options):
+    # Only the loop engine counts instructions, the count is the same either way
+    vm = VirtualMachine(**dict(vm_options, instrument=True, engine="loop", jit=False))
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.run(bytecode)
+    return vm.instrumentation_report()["instructions"]
+
+
+def bench(
+    source, repeat, warmup, compiler_options, vm_options, optimizer_options=None, profile=None
+):
+    stages, passes, bytecode = time_stages(
+        source, repeat, warmup, compiler_options, vm_options, optimizer_options, profile
+    )
+    instructions = count_instructions(bytecode, vm_options)
+    cpython = time_cpython(source, repeat, warmup)
+    return {
+        "instructions": instructions,
+        "bytecode_size": len(bytecode.code),
+        "instructions_per_second": instructions / stages["run"]["min"],
+        "stages": stages,
+        "passes": passes,
+        "total": sum(stats["min"] for stats in stages.values()),
+        "cpython": cpython,
+        "slowdown": stages["run"]["min"] / cpython["exec"]["min"],
+    }
+
+
+def run_suite(
+    names,
+    repeat,
+    warmup,
+    compiler_options=None,
+    vm_options=None,
+    deep=None,
+    optimizer_options=None,
+    profile=None,
+):
+    compiler_options = compiler_options or {}
+    vm_options = vm_options or {}
+    optimizer_options = optimizer_options or {}
+    options = (compiler_options, vm_options, optimizer_options)
+    results = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "repeat": repeat,
+        "warmup": warmup,
+        "compiler_options": compiler_options,
+        "vm_options": vm_options,
+        "optimizer_options": optimizer_options,
+        "profile": profile,
+        "workloads": {
+            name: bench(WORKLOADS[name], repeat, warmup, *options, profile)
+            for name in names
+        },
+    }
+    if deep:
+        results["deep"] = time_deep(deep, repeat, warmup, *options)
+    return results
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Benchmark the curvy pipeline")
+    parser.add_argument("workloads", nargs="*", help=f"any of {', '.join(WORKLOADS)}")
+    parser.add_argument("-r", "--repeat", type=int, default=20)
+    parser.add_argument("-w", "--warmup", type=int, default=3)
+    parser.add_argument("-o", "--output", help="write the JSON results to a file")
+    parser.add_argument("--slots", action="store_true", help="use variable slots")
+    parser.add_argument(
+        "--no-superinstructions",
+        action="store_true",
+        help="compile without fusing common instruction sequences",
+    )
+    parser.add_argument(
+        "--adaptive", action="store_true", help="specialize arithmetic as it runs"
+    )
+    parser.add_argument(
+        "--engine", choices=("loop", "closure"), help="VirtualMachine engine to run on"
+    )
+    parser.add_argument("--jit", action="store_true", help="compile hot loops to Python")
+    parser.add_argument(
+        "--licm", action="store_true", help="hoist loop-invariant arithmetic out of loops"
+    )
+    parser.add_argument(
+        "--cse", action="store_true", help="compute arithmetic repeated in a statement once"
+    )
+    parser.add_argument(
+        "--deep",
+        type=int,
+        metavar="TERMS",
+        help="also time compiling an expression with this many terms, like 100000",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="run the workloads under the sampling profiler, sampling this often",
+    )
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name!r}")
+
+    compiler_options = {}
+    vm_options = {}
+    if args.slots:
+        compiler_options["slots"] = vm_options["slots"] = True
+    if args.no_superinstructions:
+        compiler_options["superinstructions"] = False
+    if args.adaptive:
+        vm_options["adaptive"] = True
+    if args.engine:
+        vm_options["engine"] = args.engine
+    if args.jit:
+        vm_options["jit"] = True
+    optimizer_options = {}
+    if args.licm:
+        optimizer_options["licm"] = True
+    if args.cse:
+        optimizer_options["cse"] = True
+    results = run_suite(
+        args.workloads or list(WORKLOADS),
+        args.repeat,
+        args.warmup,
+        compiler_options,
+        vm_options,
+        args.deep,
+        optimizer_options,
+        args.profile,
+    )
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    for name, result in results["workloads"].items():
+        print(
+            f"{name:>12}: {result['instructions_per_second']:>12,.0f} instructions/s,"
+            f" {result['slowdown']:6.1f}x CPython",
+            file=sys.stderr,
+        )
+    if "deep" in results:
+        stages = results["deep"]["stages"]
+        print(
+            f"{'deep':>12}: {results['deep']['terms']:,} terms, optimize"
+            f" {stages['optimize']['min']:.3f}s, compile {stages['compile']['min']:.3f}s,"
+            f" build {stages['build']['min']:.3f}s",
+            file=sys.stderr,
+        )
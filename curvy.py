@@ -1,33 +1,363 @@
 import ast
-from collections import defaultdict
-from itertools import count
+import asyncio
+from bisect import bisect_right, insort
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import copy
+from itertools import accumulate, count
 import builtins
+import hashlib
+import io
+import marshal
+import mmap
+import operator
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
 import traceback
+import weakref
 
-def main(vm, user_input):
+def main(vm, user_input, cache=None):
+    # Compiling, or fetching the already compiled code from the cache
+    if cache is None:
+        bytecode = compile_source(user_input, slots=vm.slots)
+    else:
+        bytecode = cache.compile(user_input, slots=vm.slots)
+
+    # Running bytecode in the virtual machine
+    vm.run(bytecode)
+
+def compile_source(user_input, **options):
+    """ Parse, optimize and compile a source string. Return a `Code` object
+    `options` naming one of `Optimizer.PASSES` turn it on or off, the rest are passed
+    on to the `Compiler`
+    """
     # Parsing code to get tree
     tree = ast.parse(user_input)
 
     # Optimizing tree
-    optimizer = Optimizer()
-    tree = optimizer.visit(tree) ## The root node of the AST
+    passes = {name: options.pop(name) for name in Optimizer.PASSES if name in options}
+    optimizer = Optimizer(**passes)
+    tree = optimizer.optimize(tree) ## The root node of the AST
 
     # Compiling tree and building bytecode
-    compiler = Compiler()
+    compiler = Compiler(**options)
     ## Recursively generate opcodes from AST root node,
     # save them as an attribute of `compiler`
     compiler.visit([tree])
     # Returning converting opcodes to bytecode
-    bytecode = compiler.build()
+    return compiler.build()
 
-    # Running bytecode in the virtual machine
+
+class CompileCache:
+    """ Opt-in LRU cache mapping source text to its compiled `Code` object.
+    Entries are keyed by a hash of the source, and the least recently used
+    entry is evicted once there are more than `maxsize` of them.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def compile(self, source, **options):
+        """ Return the `Code` object for `source`, compiling it on a miss.
+        `options` are passed on to the `Compiler`, and are part of the key
+        """
+        key = (hashlib.sha256(source.encode()).digest(), tuple(sorted(options.items())))
+        bytecode = self.entries.get(key)
+        if bytecode is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return bytecode
+
+        self.misses += 1
+        bytecode = compile_source(source, **options)
+        self.entries[key] = bytecode
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return bytecode
+
+    def clear(self):
+        """ Drop every cached entry and reset the counters """
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+def run_file(vm, path):
+    """ Run a curvy source file, or a precompiled `.curvyc` file """
+    if path.endswith(CURVYC_SUFFIX):
+        bytecode = load_code(path)
+    else:
+        with open(path, "r") as file:
+            bytecode = compile_source(file.read())
     vm.run(bytecode)
 
+
+async def run_interleaved(jobs, count=1000):
+    """ Run (vm, bytecode) pairs on the current event loop, switching between them
+    every `count` instructions. Each VM gets a turn in order, so a long loop in one
+    script can't starve the others. Return the exception each job raised, or None.
+    """
+    return await asyncio.gather(
+        *(vm.run_async(bytecode, count) for vm, bytecode in jobs),
+        return_exceptions=True,
+    )
+
+
+def run_threaded(vm, bytecode, namespaces):
+    """ Run `bytecode` on `vm` from one thread per item of `namespaces`, all at once.
+    Each thread runs in its own Frame, in the globals dict given for it, or in the
+    VM's globals if that is None. Return the exception each thread raised, or None.
+    """
+    errors = [None] * len(namespaces)
+
+    def target(index, namespace):
+        try:
+            vm.run(bytecode, namespace)
+        except BaseException as error:
+            errors[index] = error
+
+    threads = [
+        threading.Thread(target=target, args=(index, namespace))
+        for index, namespace in enumerate(namespaces)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+# Captured output of one script run by `run_batch`, and the exception it raised if any
+BatchResult = namedtuple("BatchResult", ["output", "error"])
+
+# Each batch worker process keeps one VirtualMachine for every script it runs
+_batch_vm = None
+_batch_compiler_options = {}
+_batch_snapshot = None
+
+
+def run_batch(
+    scripts,
+    workers=None,
+    chunksize=16,
+    precompile=True,
+    vm_options=None,
+    snapshot=None,
+    **compiler_options,
+):
+    """ Run many independent scripts on a pool of worker processes.
+    `scripts` holds source strings or `Code` objects. Return a `BatchResult` per script,
+    in the same order. Each script starts with empty globals, or with the globals of
+    `snapshot`, which forked workers share with this process without copying them.
+    Scripts are sent to the workers `chunksize` at a time to cut IPC overhead. With
+    `precompile`, sources are compiled here so the workers only run bytecode.
+    """
+    results = [None] * len(scripts)
+    todo = []
+    for x, script in enumerate(scripts):
+        if precompile and isinstance(script, str):
+            try:
+                script = compile_source(script, **compiler_options)
+            except Exception as error:
+                results[x] = BatchResult("", error)
+                continue
+        todo.append((x, script))
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_batch_worker,
+        initargs=(vm_options or {}, compiler_options, snapshot),
+    ) as executor:
+        for (x, script), result in zip(
+            todo,
+            executor.map(run_batch_script, [script for x, script in todo], chunksize=chunksize),
+        ):
+            results[x] = result
+    return results
+
+
+def init_batch_worker(vm_options, compiler_options, snapshot=None):
+    global _batch_vm, _batch_compiler_options, _batch_snapshot
+    _batch_vm = VirtualMachine(**vm_options)
+    _batch_compiler_options = compiler_options
+    _batch_snapshot = snapshot
+
+
+def run_batch_script(script):
+    """ Run one script on the worker's VirtualMachine, capturing what it prints """
+    _batch_vm.globals = {} if _batch_snapshot is None else _batch_snapshot.restore()
+    output = io.StringIO()
+    error = None
+    try:
+        with contextlib.redirect_stdout(output):
+            if isinstance(script, str):
+                script = compile_source(script, **_batch_compiler_options)
+            _batch_vm.run(script)
+    except BaseException as exc:
+        # Including SystemExit from `exit()`, which would otherwise stop the whole batch
+        error = exc
+        try:
+            pickle.dumps(error)
+        except Exception:
+            # The exception has to get back to the parent process
+            error = RuntimeError(repr(exc))
+    return BatchResult(output.getvalue(), error)
+
+
+# .curvyc files: a fixed header followed by the marshalled names and consts
+# tuples, then the raw code bytes and the line table
+CURVYC_SUFFIX = ".curvyc"
+CURVYC_MAGIC = b"CRVY"
+CURVYC_VERSION = 3
+# magic, version, stack size, names length, consts length, code length, line table length
+CURVYC_HEADER = struct.Struct("<4sHIIIII")
+
+
+def dump_code(bytecode) -> bytes:
+    """ Serialize a `Code` object to the .curvyc format """
+    names = marshal.dumps(bytecode.names)
+    consts = marshal.dumps(bytecode.consts)
+    header = CURVYC_HEADER.pack(
+        CURVYC_MAGIC,
+        CURVYC_VERSION,
+        bytecode.stacksize,
+        len(names),
+        len(consts),
+        len(bytecode.code),
+        len(bytecode.linetable),
+    )
+    return b"".join((header, names, consts, bytes(bytecode.code), bytecode.linetable))
+
+
+def save_code(bytecode, path):
+    with open(path, "wb") as file:
+        file.write(dump_code(bytecode))
+
+
+def load_code(path):
+    """ Load a `Code` object from a .curvyc file.
+    The file is memory-mapped, and the code section is a view into the mapping
+    rather than a copy. The mapping stays open for as long as the Code is alive.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < CURVYC_HEADER.size:
+            raise ValueError(f"{path!r} is not a curvyc file")
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (
+        magic,
+        version,
+        stacksize,
+        names_len,
+        consts_len,
+        code_len,
+        linetable_len,
+    ) = CURVYC_HEADER.unpack_from(mapping)
+    if magic != CURVYC_MAGIC:
+        raise ValueError(f"{path!r} is not a curvyc file")
+    if version != CURVYC_VERSION:
+        raise ValueError(f"{path!r} has unsupported curvyc version {version}")
+    size = CURVYC_HEADER.size + names_len + consts_len + code_len + linetable_len
+    if size > len(mapping):
+        raise ValueError(f"{path!r} is truncated: {len(mapping)} of {size} bytes")
+
+    start = CURVYC_HEADER.size
+    names = marshal.loads(mapping[start:start + names_len])
+    start += names_len
+    consts = marshal.loads(mapping[start:start + consts_len])
+    start += consts_len
+    code = memoryview(mapping)[start:start + code_len]
+    start += code_len
+    linetable = mapping[start:start + linetable_len]
+    return Code(names, consts, code, stacksize, linetable)
+
+
 class Code:
-    def __init__(self, names, consts, code):
+    def __init__(self, names, consts, code, stacksize, linetable=b""):
         self.names = names  # Variable Names for whole code
         self.consts = consts  # Constants for whole code
-        self.code = code  # Byte string [opcode, oparg]
+        self.code = code  # Byte string (or memoryview of one) [opcode, oparg]
+        self.stacksize = stacksize  # Maximum depth of the value stack
+        # Source line of each decoded instruction, as pairs of bytes: the number of
+        # instructions since the last pair, then the signed change in line number
+        self.linetable = linetable
+        self.decoded = None  # List of (opcode, oparg), built by `decode` on first run
+        self.uses_slots = False  # Whether the code uses variable slots, set by `decode`
+        self.decoded_lines = None  # Built by `lines` on first use
+
+    def __reduce__(self):
+        # Pickle without the decoded instructions, and copy code out of a memory-mapped file
+        return (
+            Code,
+            (self.names, self.consts, bytes(self.code), self.stacksize, self.linetable),
+        )
+
+    def decode(self):
+        """ Return the code as a list of (opcode, full oparg) pairs, one per instruction.
+        EXTENDED_ARG prefixes are folded into the oparg of the instruction they extend,
+        and jump targets are remapped to indices into the decoded list.
+        The list is built once and cached on the Code object.
+        """
+        if self.decoded is not None:
+            return self.decoded
+
+        extended_arg = OPCODES["EXTENDED_ARG"]
+        instructions = []
+        # Index of each raw [opcode, oparg] unit in the decoded list
+        positions = []
+        oparg = 0
+        for opcode, arg in zip(self.code[::2], self.code[1::2]):
+            positions.append(len(instructions))
+            oparg = (oparg << 8) + arg
+            if opcode == extended_arg:
+                continue
+            instructions.append((opcode, oparg))
+            oparg = 0
+        positions.append(len(instructions))
+
+        self.uses_slots = any(opcode in HASSLOT for opcode, oparg in instructions)
+        self.decoded = [
+            (opcode, positions[oparg] if opcode in HASJUMP else oparg)
+            for opcode, oparg in instructions
+        ]
+        return self.decoded
+
+    def lines(self):
+        """ Return the source line of each decoded instruction, indexed like `decode`.
+        Instructions with no known line, like all of them in code built without a line
+        table, are on line 0. The list is built once and cached on the Code object.
+        """
+        if self.decoded_lines is not None:
+            return self.decoded_lines
+
+        lines = []
+        line = 0
+        for delta, line_delta in zip(self.linetable[::2], self.linetable[1::2]):
+            lines += [line] * delta
+            line += line_delta - 256 if line_delta > 127 else line_delta
+        lines += [line] * (len(self.decode()) - len(lines))
+        self.decoded_lines = lines
+        return lines
 
 
 # Data
@@ -62,51 +392,443 @@ OPNAMES = [
     "INDEX",
     "EXTENDED_ARG",  # args larger than 255
     "JUMP",
-    "JUMP_IF_FALSE",
+    "JUMP_IF_FALSE", # No longer compiled, tests pop their value with POP_JUMP_IF_FALSE
     "GET_ITER", # pops the top of the stack, turns it into an iterator and puts it back on top of the stack
     "FOR_ITER", # Will either call next() on the top of the stack (hopefully its an iterator). If the iterator is exausted, jump to the arg
     "CALL_FUNCTION",
+    "LOAD_FAST",  # Variable slots, see `Compiler(slots=True)`
+    "STORE_FAST",
+    "DEL_FAST",
+    "GET_RANGE_ITER", # Pops range and its oparg args, pushes a counter and bound (or an iterator and None if range isn't the builtin)
+    "FOR_RANGE", # FOR_ITER for the stack left by GET_RANGE_ITER
+    # Type-specialized arithmetic, see `VirtualMachine(adaptive=True)`
+    "BINARY_ADD_INT",
+    "BINARY_ADD_FLOAT",
+    "BINARY_SUB_INT",
+    "BINARY_SUB_FLOAT",
+    "BINARY_MUL_INT",
+    "BINARY_MUL_FLOAT",
+    # Superinstructions, see `Compiler(superinstructions=True)`
+    "BINARY_OP_NAME_CONST", # LOAD_NAME; LOAD_CONST; BINARY_*. Oparg is name << 24 | const << 8 | binary opcode
+    "INPLACE_OP_NAME_CONST", # BINARY_OP_NAME_CONST; STORE_NAME to the same name
+    "LOAD_NAME_NAME", # LOAD_NAME; LOAD_NAME. Oparg is first name << 16 | second name
+    "BINARY_OP_FAST_CONST", # As above, for variable slots
+    "INPLACE_OP_FAST_CONST",
+    "LOAD_FAST_FAST",
+    "POP_JUMP_IF_FALSE", # JUMP_IF_FALSE that pops the test, replacing the POP_TOP on both edges
+    "POP_JUMP_IF_TRUE",
+    "JUMP_IF_FALSE_OR_POP", # Keeps the test if it jumps and pops it otherwise, for `and`
+    "JUMP_IF_TRUE_OR_POP", # The same for `or`
+    "COMPARE_OP", # Oparg indexes COMPARE_OPERATORS
+    "ROT_TWO", # Swaps the top two values
+    "ROT_THREE", # Moves the top value down under the next two
+    # COMPARE_OP; POP_JUMP_IF_FALSE for each rich comparison, see `Compiler(superinstructions=True)`
+    "POP_JUMP_IF_NOT_LT",
+    "POP_JUMP_IF_NOT_LE",
+    "POP_JUMP_IF_NOT_EQ",
+    "POP_JUMP_IF_NOT_NE",
+    "POP_JUMP_IF_NOT_GT",
+    "POP_JUMP_IF_NOT_GE",
 ]
 
 OPCODES = {opname: opcode for opcode, opname in enumerate(OPNAMES)}
 
-
-class Optimizer(ast.NodeTransformer):
-    """ Given an AST, optimizes things that dont need to be compiled. Inheritance takes care of visiting functions from tree."""
+# Opcodes whose oparg is the position of an instruction to jump to
+HASJUMP = {
+    OPCODES[opname]
+    for opname in (
+        "JUMP",
+        "JUMP_IF_FALSE",
+        "FOR_ITER",
+        "FOR_RANGE",
+        "POP_JUMP_IF_FALSE",
+        "POP_JUMP_IF_TRUE",
+        "JUMP_IF_FALSE_OR_POP",
+        "JUMP_IF_TRUE_OR_POP",
+        "POP_JUMP_IF_NOT_LT",
+        "POP_JUMP_IF_NOT_LE",
+        "POP_JUMP_IF_NOT_EQ",
+        "POP_JUMP_IF_NOT_NE",
+        "POP_JUMP_IF_NOT_GT",
+        "POP_JUMP_IF_NOT_GE",
+    )
+}
+# Jumps taken depending on a value. Jump threading can make one the back edge of a loop,
+# see `VirtualMachine.conditional_back_edge`
+CONDITIONAL_JUMPS = HASJUMP - {OPCODES[opname] for opname in ("JUMP", "FOR_ITER", "FOR_RANGE")}
+
+# Generic binary opcode -> the operation it performs, for superinstructions
+BINARY_OPERATORS = {
+    OPCODES["BINARY_ADD"]: operator.add,
+    OPCODES["BINARY_SUB"]: operator.sub,
+    OPCODES["BINARY_DIV"]: operator.truediv,
+    OPCODES["BINARY_MUL"]: operator.mul,
+    OPCODES["BINARY_MOD"]: operator.mod,
+    OPCODES["BINARY_POW"]: operator.pow,
+    OPCODES["BINARY_FLOORDIV"]: operator.floordiv,
+    OPCODES["BIT_AND"]: operator.and_,
+    OPCODES["BIT_OR"]: operator.or_,
+    OPCODES["BIT_XOR"]: operator.xor,
+    OPCODES["LSHIFT"]: operator.lshift,
+    OPCODES["RSHIFT"]: operator.rshift,
+}
+
+# COMPARE_OP oparg -> the Python operator it compares with
+COMPARE_NAMES = ("<", "<=", "==", "!=", ">", ">=", "is", "is not", "in", "not in")
+# ... and the function comparing with it
+COMPARE_OPERATORS = (
+    operator.lt,
+    operator.le,
+    operator.eq,
+    operator.ne,
+    operator.gt,
+    operator.ge,
+    operator.is_,
+    operator.is_not,
+    lambda left, right: left in right,
+    lambda left, right: left not in right,
+)
+# Fused compare-and-branch opcode -> the COMPARE_OP oparg whose result it jumps on
+COMPARE_JUMPS = {
+    OPCODES[f"POP_JUMP_IF_NOT_{name}"]: oparg
+    for oparg, name in enumerate(("LT", "LE", "EQ", "NE", "GT", "GE"))
+}
+
+# Opcodes whose oparg is, or packs, a variable slot
+HASSLOT = {
+    OPCODES[opname]
+    for opname in (
+        "LOAD_FAST",
+        "STORE_FAST",
+        "DEL_FAST",
+        "BINARY_OP_FAST_CONST",
+        "INPLACE_OP_FAST_CONST",
+        "LOAD_FAST_FAST",
+    )
+}
+
+# Generic arithmetic opcode -> {operand type: specialized opcode}
+SPECIALIZATIONS = {
+    OPCODES[generic]: {
+        int: OPCODES[f"{generic}_INT"], float: OPCODES[f"{generic}_FLOAT"]
+    }
+    for generic in ("BINARY_ADD", "BINARY_SUB", "BINARY_MUL")
+}
+# How many times in a row an instruction sees the same operand types before it is specialized
+ADAPTIVE_WARMUP = 8
+# How many times a loop jumps back to its start before it is compiled to Python
+JIT_THRESHOLD = 50
+
+# Value of a variable slot with nothing stored in it
+UNBOUND = object()
+
+# Change in stack depth for opcodes whose effect doesn't depend on their oparg
+STACK_EFFECTS = {
+    "LOAD_CONST": 1,
+    "PRINT_EXPR": -1,
+    "DUP_TOP": 1,
+    "POP_TOP": -1,
+    "LOAD_NAME": 1,
+    "STORE_NAME": -1,
+    "DEL_NAME": 0,
+    "LOAD_FAST": 1,
+    "STORE_FAST": -1,
+    "DEL_FAST": 0,
+    "BINARY_ADD": -1,
+    "BINARY_ADD_INT": -1,
+    "BINARY_ADD_FLOAT": -1,
+    "BINARY_SUB_INT": -1,
+    "BINARY_SUB_FLOAT": -1,
+    "BINARY_MUL_INT": -1,
+    "BINARY_MUL_FLOAT": -1,
+    "BINARY_SUB": -1,
+    "BINARY_DIV": -1,
+    "BINARY_MUL": -1,
+    "BINARY_MOD": -1,
+    "BINARY_POW": -1,
+    "BINARY_FLOORDIV": -1,
+    "BIT_AND": -1,
+    "BIT_OR": -1,
+    "BIT_XOR": -1,
+    "LSHIFT": -1,
+    "RSHIFT": -1,
+    "UNARY_ADD": 0,
+    "UNARY_SUB": 0,
+    "UNARY_NOT": 0,
+    "UNARY_INVERT": 0,
+    "INDEX": -1,
+    "JUMP": 0,
+    "JUMP_IF_FALSE": 0,
+    "GET_ITER": 0,
+    "BINARY_OP_NAME_CONST": 1,
+    "INPLACE_OP_NAME_CONST": 0,
+    "LOAD_NAME_NAME": 2,
+    "BINARY_OP_FAST_CONST": 1,
+    "INPLACE_OP_FAST_CONST": 0,
+    "LOAD_FAST_FAST": 2,
+    "POP_JUMP_IF_FALSE": -1,
+    "POP_JUMP_IF_TRUE": -1,
+    "COMPARE_OP": -1,
+    "ROT_TWO": 0,
+    "ROT_THREE": 0,
+    "POP_JUMP_IF_NOT_LT": -2,
+    "POP_JUMP_IF_NOT_LE": -2,
+    "POP_JUMP_IF_NOT_EQ": -2,
+    "POP_JUMP_IF_NOT_NE": -2,
+    "POP_JUMP_IF_NOT_GT": -2,
+    "POP_JUMP_IF_NOT_GE": -2,
+}
+
+
+def stack_effect(opcode, oparg, jump=False):
+    """ Return the change in stack depth caused by running an instruction.
+    `jump` selects the effect when a conditional jump is taken.
+    """
+    opname = OPNAMES[opcode]
+    if opname in ("BUILD_LIST", "BUILD_TUPLE", "BUILD_SET"):
+        return 1 - oparg
+    elif opname == "BUILD_DICT":
+        return 1 - 2 * oparg
+    elif opname == "CALL_FUNCTION":
+        return -oparg
+    elif opname in ("FOR_ITER", "FOR_RANGE"):
+        # Pushes the next value, or leaves the exhausted iterator and jumps
+        return 0 if jump else 1
+    elif opname == "GET_RANGE_ITER":
+        return 1 - oparg
+    elif opname in ("JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP"):
+        return 0 if jump else -1
+    return STACK_EFFECTS[opname]
+
+
+class Transformer(ast.NodeTransformer):
+    """ Like `ast.NodeTransformer`, `visit_*` methods return the node to replace theirs with,
+    but the tree is walked bottom-up with an explicit stack: each method gets a node
+    whose children have already been transformed, and mustn't visit them itself.
+    """
+
+    # AST node type -> `visit_*` method, or None for nodes left as they are
+    handlers = {}
+    # Subclasses that only transform statements can skip expressions,
+    # which never contain any
+    walks = ast.AST
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.handlers = {}
+
+    def visit(self, tree):
+        """ Transform every node of `tree`, children first. Return the new root """
+        # Every node with children, parents before their children
+        nodes = []
+        todo = [tree]
+        walks = self.walks
+        while todo:
+            node = todo.pop()
+            if not node._fields:
+                continue
+            nodes.append(node)
+            for field in node._fields:
+                value = getattr(node, field, None)
+                if isinstance(value, list):
+                    todo.extend(item for item in value if isinstance(item, walks))
+                elif isinstance(value, walks):
+                    todo.append(value)
+
+        # id of each node replaced -> what replaces it: a node, a list of nodes, or None
+        # to remove it
+        replaced = {}
+        handlers = self.handlers
+        for node in reversed(nodes):
+            if replaced:
+                self.replace_children(node, replaced)
+            node_type = type(node)
+            if node_type not in handlers:
+                handlers[node_type] = getattr(type(self), f"visit_{node_type.__name__}", None)
+            handler = handlers[node_type]
+            if handler is not None:
+                result = handler(self, node)
+                if result is not node:
+                    replaced[id(node)] = result
+        return replaced.get(id(tree), tree)
+
+    @staticmethod
+    def replace_children(node, replaced):
+        """ Put the replacements of `node`'s children in, like `generic_visit` would """
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                if not any(id(item) in replaced for item in value):
+                    continue
+                items = []
+                for item in value:
+                    item = replaced.get(id(item), item)
+                    if item is None:
+                        continue
+                    elif isinstance(item, list):
+                        items.extend(item)
+                    else:
+                        items.append(item)
+                value[:] = items
+            elif id(value) in replaced:
+                new = replaced[id(value)]
+                if new is None:
+                    delattr(node, field)
+                else:
+                    setattr(node, field, new)
+
+
+class Optimizer(Transformer):
+    """ Given an AST, optimizes things that dont need to be compiled.
+    `visit` folds constants, and `optimize` runs it followed by the other enabled passes:
+    `licm` hoists loop-invariant arithmetic out of loops, and `cse` computes arithmetic
+    repeated within a statement once. These two store their results in variables named
+    like `.licm0` and `.cse0`, and are off by default.
+    """
+
+    # Passes `optimize` runs, in order
+    PASSES = ("fold", "licm", "cse")
+
+    def __init__(self, fold=True, licm=False, cse=False):
+        self.passes = [name for name, on in zip(self.PASSES, (fold, licm, cse)) if on]
+        self.timings = {}  # Pass name -> seconds it took
+        self.hoisted = 0
+        self.reused = 0
+        # Numbers for the variables the passes add, unique across passes
+        self.temps = count()
+
+    def optimize(self, tree):
+        """ Run every enabled pass over `tree`, timing each one. Return the new root """
+        passes = {
+            "fold": self.visit,
+            "licm": self.hoist_invariants,
+            "cse": self.reuse_subexpressions,
+        }
+        for name in self.passes:
+            start = time.perf_counter()
+            tree = passes[name](tree)
+            self.timings[name] = time.perf_counter() - start
+        return tree
+
+    def hoist_invariants(self, tree):
+        hoister = HoistInvariants(self.temps)
+        tree = hoister.visit(tree)
+        self.hoisted += hoister.hoisted
+        return tree
+
+    def reuse_subexpressions(self, tree):
+        reuser = ReuseSubexpressions(self.temps)
+        tree = reuser.visit(tree)
+        self.reused += reuser.reused
+        return tree
+
+    # Folds producing values larger than these are left to the VM, so that
+    # something like `2 ** 10 ** 10` can't stall the compiler
+    MAX_INT_BITS = 4096
+    MAX_SEQUENCE_SIZE = 4096
 
     def visit_BinOp(self, node):
         """ Optimize BinOp nodes between two constants """
-        node = self.generic_visit(node)
         if isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
-            if isinstance(node.op, ast.Add):
-                return ast.Constant(node.left.value + node.right.value)
-            elif isinstance(node.op, ast.Sub):
-                return ast.Constant(node.left.value - node.right.value)
-            elif isinstance(node.op, ast.Mult):
-                return ast.Constant(node.left.value * node.right.value)
-            elif isinstance(node.op, ast.Div):
-                return ast.Constant(node.left.value / node.right.value)
-            elif isinstance(node.op, ast.FloorDiv):
-                return ast.Constant(node.left.value // node.right.value)
-            elif isinstance(node.op, ast.Mod):
-                return ast.Constant(node.left.value % node.right.value)
-            elif isinstance(node.op, ast.Pow):
-                return ast.Constant(node.left.value ** node.right.value)
-            elif isinstance(node.op, ast.BitAnd):
-                return ast.Constant(node.left.value & node.right.value)
-            elif isinstance(node.op, ast.BitOr):
-                return ast.Constant(node.left.value | node.right.value)
-            elif isinstance(node.op, ast.BitXor):
-                return ast.Constant(node.left.value ^ node.right.value)
-            elif isinstance(node.op, ast.LShift):
-                return ast.Constant(node.left.value << node.right.value)
-            elif isinstance(node.op, ast.RShift):
-                return ast.Constant(node.left.value >> node.right.value)
+            left, right = node.left.value, node.right.value
+            if not self.safe_to_fold(node.op, left, right):
+                return node
+            # Folding must never raise, expressions like `1 / 0` are left to fail at runtime
+            try:
+                if isinstance(node.op, ast.Add):
+                    return ast.Constant(left + right)
+                elif isinstance(node.op, ast.Sub):
+                    return ast.Constant(left - right)
+                elif isinstance(node.op, ast.Mult):
+                    return ast.Constant(left * right)
+                elif isinstance(node.op, ast.Div):
+                    return ast.Constant(left / right)
+                elif isinstance(node.op, ast.FloorDiv):
+                    return ast.Constant(left // right)
+                elif isinstance(node.op, ast.Mod):
+                    return ast.Constant(left % right)
+                elif isinstance(node.op, ast.Pow):
+                    return ast.Constant(left ** right)
+                elif isinstance(node.op, ast.BitAnd):
+                    return ast.Constant(left & right)
+                elif isinstance(node.op, ast.BitOr):
+                    return ast.Constant(left | right)
+                elif isinstance(node.op, ast.BitXor):
+                    return ast.Constant(left ^ right)
+                elif isinstance(node.op, ast.LShift):
+                    return ast.Constant(left << right)
+                elif isinstance(node.op, ast.RShift):
+                    return ast.Constant(left >> right)
+            except Exception:
+                return node
+        return node
+
+    def safe_to_fold(self, op, left, right) -> bool:
+        """ Return False if folding `left op right` could build a huge value """
+        if isinstance(op, ast.Pow) and isinstance(left, int) and isinstance(right, int):
+            return right < 0 or left.bit_length() * right <= self.MAX_INT_BITS
+        if isinstance(op, ast.LShift) and isinstance(left, int) and isinstance(right, int):
+            return right < 0 or left.bit_length() + right <= self.MAX_INT_BITS
+        if isinstance(op, ast.Mult):
+            for seq, times in ((left, right), (right, left)):
+                if isinstance(seq, (str, bytes, tuple)) and isinstance(times, int):
+                    return len(seq) * times <= self.MAX_SEQUENCE_SIZE
+        return True
+
+    def visit_UnaryOp(self, node):
+        """ Optimize UnaryOp nodes on a constant """
+        if isinstance(node.operand, ast.Constant):
+            operand = node.operand.value
+            try:
+                if isinstance(node.op, ast.UAdd):
+                    return ast.Constant(+operand)
+                elif isinstance(node.op, ast.USub):
+                    return ast.Constant(-operand)
+                elif isinstance(node.op, ast.Not):
+                    return ast.Constant(not operand)
+                elif isinstance(node.op, ast.Invert):
+                    return ast.Constant(~operand)
+            except Exception:
+                return node
+        return node
+
+    def visit_Compare(self, node):
+        """ Optimize comparisons between constants """
+        values = [node.left] + node.comparators
+        if not all(isinstance(value, ast.Constant) for value in values):
+            return node
+        try:
+            for x, op in enumerate(node.ops):
+                operation = COMPARE_OPERATORS[Compiler.COMPARISONS[type(op)]]
+                result = operation(values[x].value, values[x + 1].value)
+                if not result:
+                    break
+        except Exception:
+            return node
+        return ast.Constant(result)
+
+    def visit_If(self, node):
+        """ Replace an if statement with a constant test by the branch that runs """
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+        return node
+
+    def visit_IfExp(self, node):
+        """ Replace an if expression with a constant test by the branch that runs """
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+        return node
+
+    def visit_While(self, node):
+        """ Drop loops whose constant test is false.
+        Loops with a true constant test are compiled without a test, see `Compiler.visit_While`
+        """
+        if isinstance(node.test, ast.Constant) and not node.test.value:
+            return node.orelse
         return node
 
     def visit_Tuple(self, node):
         """ Optimize building tuple of only constants."""
-        self.generic_visit(node)
         new_elts = []
         for child in node.elts:
             # Optimizing child nodes, for nested constants
@@ -116,93 +838,802 @@ class Optimizer(ast.NodeTransformer):
         return ast.Constant(tuple(new_elts))
 
 
+def evaluation_order(expr, parent=None):
+    """ Return (node, parent, conditional) for every expression node in `expr`, in the order
+    the compiled code evaluates them. `conditional` is True for nodes that might not be
+    evaluated, like the branches of an `ast.IfExp`
+    """
+    nodes = []
+    todo = [(expr, parent, False)]
+    while todo:
+        node, parent, conditional = todo.pop()
+        nodes.append((node, parent, conditional))
+        node_type = type(node)
+        if node_type is ast.BinOp:
+            todo += ((node.right, node, conditional), (node.left, node, conditional))
+            continue
+        elif node_type is ast.Name or node_type is ast.Constant:
+            continue
+        elif node_type is ast.IfExp:
+            children = [(node.test, conditional), (node.body, True), (node.orelse, True)]
+        elif node_type is ast.BoolOp:
+            # Short-circuits after each value
+            children = [(node.values[0], conditional)]
+            children += [(value, True) for value in node.values[1:]]
+        elif node_type is ast.Compare:
+            # A chain of comparisons stops at the first false one
+            children = [(node.left, conditional), (node.comparators[0], conditional)]
+            children += [(value, True) for value in node.comparators[1:]]
+        elif node_type is ast.Dict:
+            # `Compiler.visit_Dict` evaluates each value before its key
+            children = [
+                (child, conditional) for pair in zip(node.values, node.keys) for child in pair
+            ]
+        else:
+            children = [
+                (child, conditional)
+                for child in ast.iter_child_nodes(node)
+                if isinstance(child, ast.expr)
+            ]
+        todo.extend((child, node, conditional) for child, conditional in reversed(children))
+    return nodes
+
+def pure_expressions(nodes, assigned=(), keys=None):
+    """ Given the nodes from `evaluation_order`, return {id(node): (key, size)} for those
+    that only do arithmetic, comparisons and `and`/`or` on constants and names not in
+    `assigned`.
+    Nodes with the same key are the same expression, `size` is its number of instructions.
+    Pass the same `keys` dict to compare keys across calls.
+    Arithmetic is assumed to have no side effects, though it can raise
+    """
+    keys = {} if keys is None else keys
+    pure = {}
+    # Children come after their parent, so this sees them first
+    for node, parent, conditional in reversed(nodes):
+        node_type = type(node)
+        if node_type is ast.Name:
+            if node.id in assigned:
+                continue
+            key, size = (node_type, node.id), 1
+        elif node_type is ast.Constant:
+            value = node.value
+            if type(value) in (float, complex):
+                # Tells 0.0 and -0.0 apart
+                value = repr(value)
+            elif type(value) not in (int, str, bytes, bool, type(None)):
+                continue
+            key, size = (node_type, type(node.value), value), 1
+        elif node_type is ast.BinOp:
+            left, right = pure.get(id(node.left)), pure.get(id(node.right))
+            if left is None or right is None:
+                continue
+            key, size = (node_type, type(node.op), left[0], right[0]), left[1] + right[1] + 1
+        elif node_type is ast.UnaryOp:
+            operand = pure.get(id(node.operand))
+            if operand is None:
+                continue
+            key, size = (node_type, type(node.op), operand[0]), operand[1] + 1
+        elif node_type is ast.BoolOp or node_type is ast.Compare:
+            if node_type is ast.BoolOp:
+                values, ops = node.values, type(node.op)
+            else:
+                values, ops = [node.left] + node.comparators, tuple(map(type, node.ops))
+            operands = [pure.get(id(value)) for value in values]
+            if None in operands:
+                continue
+            if node_type is ast.BoolOp:
+                # A jump after each value but the last
+                extra = len(values) - 1
+            else:
+                # A COMPARE_OP, or in a chain DUP_TOP; ROT_THREE; COMPARE_OP; JUMP_IF_*
+                # for each link but the last, and a JUMP at the end
+                extra = 1 if len(values) == 2 else 4 * len(values) - 6
+            key = (node_type, ops) + tuple(operand[0] for operand in operands)
+            size = sum(operand[1] for operand in operands) + extra
+        else:
+            continue
+        pure[id(node)] = (keys.setdefault(key, len(keys)), size)
+    return pure
+
+# Expressions worth storing in a variable rather than recomputing
+OPERATIONS = (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare)
+
+def subtree_ends(nodes):
+    """ Given the nodes from `evaluation_order`, return {id(node): index} of the last node
+    of each node's subtree, which is evaluated just before the node's own operation
+    """
+    last = {}
+    for x in range(len(nodes) - 1, -1, -1):
+        node, parent, conditional = nodes[x]
+        last.setdefault(id(node), x)
+        last[id(parent)] = max(last.get(id(parent), 0), last[id(node)])
+    return last
+
+def delete_temps(temps, statement):
+    """ Return a `del` of the variables named `temps`, located at `statement` """
+    targets = [ast.Name(temp, ast.Del()) for temp in temps]
+    return ast.copy_location(ast.Delete(targets), statement)
+
+def copy_expression(expr):
+    """ Return a copy of the expression nodes of `expr`, like `copy.deepcopy` without
+    recursing, so it works on expressions of any depth. Other nodes, like operators,
+    are shared with `expr`
+    """
+    copies = {}
+    # Children come after their parent, so this copies them first
+    for node, parent, conditional in reversed(evaluation_order(expr)):
+        new = copies[id(node)] = copy.copy(node)
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                setattr(new, field, [copies.get(id(item), item) for item in value])
+            elif id(value) in copies:
+                setattr(new, field, copies[id(value)])
+    return copies[id(expr)]
+
+def replace_child(parent, child, new):
+    """ Put `new` in place of `child` in `parent` """
+    for field in parent._fields:
+        value = getattr(parent, field, None)
+        if value is child:
+            setattr(parent, field, new)
+            return
+        elif isinstance(value, list):
+            for x, item in enumerate(value):
+                if item is child:
+                    value[x] = new
+                    return
+    assert False, "not a child"  # pragma: no cover
+
+
+class HoistInvariants(Transformer):
+    """ Loop-invariant code motion: arithmetic on names a loop never assigns is computed
+    once before the loop, instead of on every iteration.
+    Hoisted expressions are computed after checking the loop will run at least once, and
+    only if nothing the first iteration does before them could raise or have an effect,
+    other than assigning names. That includes loading a name that might be unbound. So if one raises, the loop would have raised at the
+    same point, but names it assigned before then are left as they were.
+    `while` loops are checked with their test, if it's itself arithmetic, and `for`
+    loops only when they loop over a range of arithmetic. The variables holding hoisted
+    expressions are deleted after the loop.
+    """
+
+    walks = ast.stmt
+
+    def __init__(self, temps):
+        self.temps = temps
+        self.hoisted = 0
+
+    def visit_While(self, node):
+        if node.orelse:
+            return node
+        if isinstance(node.test, ast.Constant):
+            # `while 1:` always runs its body
+            guard = None
+        elif id(node.test) in pure_expressions(evaluation_order(node.test)):
+            guard = copy_expression(node.test)
+        else:
+            return node
+        roots = [(node, node.test)] + self.first_iteration(node.body)
+        return self.hoist(node, roots, guard, node.test)
+
+    def visit_For(self, node):
+        if not Compiler.is_range_call(node.iter):
+            return node
+        for arg in node.iter.args:
+            if id(arg) not in pure_expressions(evaluation_order(arg)):
+                return node
+        # A range is false when empty
+        args = [copy_expression(arg) for arg in node.iter.args]
+        guard = ast.Call(ast.Name("range", ast.Load()), args, [])
+        return self.hoist(node, self.first_iteration(node.body), guard)
+
+    @staticmethod
+    def first_iteration(body):
+        """ Return (statement, expression) for the expressions evaluated first every time
+        `body` runs, up to the first statement doing more than assigning names
+        """
+        roots = []
+        for statement in body:
+            if isinstance(statement, ast.Pass):
+                continue
+            elif isinstance(statement, ast.Assign):
+                roots.append((statement, statement.value))
+                if all(isinstance(target, ast.Name) for target in statement.targets):
+                    continue
+            elif isinstance(statement, (ast.AugAssign, ast.Expr)):
+                roots.append((statement, statement.value))
+            elif isinstance(statement, (ast.If, ast.While)):
+                roots.append((statement, statement.test))
+            elif isinstance(statement, ast.For):
+                roots.append((statement, statement.iter))
+            break
+        return roots
+
+    def hoist(self, loop, roots, guard, tested=None):
+        """ Move the invariant expressions in `roots` before `loop`, inside `if guard:`.
+        Stops at the first operation of `roots` it doesn't hoist, or load of a name not
+        known to be bound, apart from in `tested`, which `guard` evaluates before the
+        hoisted expressions run
+        """
+        assigned = {
+            node.id
+            for node in ast.walk(loop)
+            if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load)
+        }
+        # Names bound where the first iteration has got to: those `guard` just loaded,
+        # the loop's target, and those assigned since
+        bound = set()
+        if isinstance(loop, ast.For):
+            for arg in loop.iter.args:
+                bound.update(
+                    node.id for node, parent, conditional in evaluation_order(arg)
+                    if type(node) is ast.Name
+                )
+            if isinstance(loop.target, ast.Name):
+                bound.add(loop.target.id)
+        keys = {}
+        temps = {}  # Expression key -> its variable
+        statements = []
+        for statement, root in roots:
+            nodes = evaluation_order(root, statement)
+            pure = pure_expressions(nodes, assigned, keys)
+            if root is tested:
+                bound.update(
+                    node.id for node, parent, conditional in nodes if type(node) is ast.Name
+                )
+            last = subtree_ends(nodes)
+            # Nodes after this index are evaluated after an operation that isn't hoisted
+            limit = len(nodes)
+            hoisted = set()
+            for x, (node, parent, conditional) in enumerate(nodes):
+                if x > limit:
+                    break
+                if id(parent) in hoisted:
+                    # Part of an expression already hoisted
+                    hoisted.add(id(node))
+                    continue
+                if conditional or id(node) not in pure or not isinstance(node, OPERATIONS):
+                    if root is tested or isinstance(node, ast.Constant):
+                        continue
+                    if not isinstance(node, ast.Name) or node.id not in bound:
+                        limit = min(limit, last[id(node)])
+                    continue
+                hoisted.add(id(node))
+                key = pure[id(node)][0]
+                if key not in temps:
+                    temps[key] = f".licm{next(self.temps)}"
+                    target = ast.Name(temps[key], ast.Store())
+                    statements.append(ast.copy_location(ast.Assign([target], node), loop))
+                load = ast.Name(temps[key], ast.Load())
+                replace_child(parent, node, ast.copy_location(load, node))
+                self.hoisted += 1
+            if limit < len(nodes):
+                break
+            if isinstance(statement, ast.Assign):
+                bound.update(
+                    target.id for target in statement.targets if isinstance(target, ast.Name)
+                )
+
+        if not statements:
+            return loop
+        # There's no `break`, so a loop is only left through its test, or by raising
+        body = statements + [loop, delete_temps(list(temps.values()), loop)]
+        if guard is None:
+            return body
+        return ast.copy_location(ast.If(guard, body, []), loop)
+
+
+class ReuseSubexpressions(Transformer):
+    """ Common subexpression elimination: arithmetic repeated within a statement is computed
+    once, and stored for the other times with `:=`.
+    Only expressions whose first time is always evaluated are reused, and only when that
+    runs fewer instructions. Names the statement assigns with `:=` are never part of one.
+    The variables are deleted after the statement.
+    """
+
+    walks = ast.stmt
+
+    def __init__(self, temps):
+        self.temps = temps
+        self.reused = 0
+
+    def visit_Assign(self, node):
+        return self.reuse(node, node.value)
+
+    visit_AugAssign = visit_Expr = visit_Assign
+
+    def visit_If(self, node):
+        return self.reuse(node, node.test)
+
+    visit_While = visit_If
+
+    def visit_For(self, node):
+        return self.reuse(node, node.iter)
+
+    def reuse(self, statement, expr):
+        """ Return `statement` with the expressions of `expr` reused, followed by the
+        deletion of their variables once it's done
+        """
+        nodes = evaluation_order(expr, statement)
+        assigned = {
+            node.target.id
+            for node, parent, conditional in nodes
+            if isinstance(node, ast.NamedExpr)
+        }
+        pure = pure_expressions(nodes, assigned)
+        last = subtree_ends(nodes)
+        index = {}  # id of each node -> its index in `nodes`
+        uses = defaultdict(list)
+        for x, (node, parent, conditional) in enumerate(nodes):
+            index[id(node)] = x
+            if id(node) in pure and isinstance(node, OPERATIONS):
+                uses[pure[id(node)][0]].append((node, parent, conditional))
+
+        def saving(occurrences):
+            # Each reuse skips the expression but loads the variable, and storing it
+            # takes a DUP_TOP and a STORE, and deleting it a DEL
+            return (pure[id(occurrences[0][0])][1] - 1) * (len(occurrences) - 1) - 3
+
+        # Expressions are reused from one walk of the statement, the ones saving the most
+        # instructions first. Those inside a later use of one already reused are gone, and
+        # one can't be reused if it contains another
+        candidates = sorted(
+            (occurrences for occurrences in uses.values() if saving(occurrences) > 0),
+            key=saving,
+            reverse=True,
+        )
+        starts = []  # Sorted indices of every use of the expressions reused so far
+        temps = []
+        gone = [False] * len(nodes)
+        for occurrences in candidates:
+            occurrences = [
+                occurrence for occurrence in occurrences if not gone[index[id(occurrence[0])]]
+            ]
+            if len(occurrences) < 2 or occurrences[0][2] or saving(occurrences) <= 0:
+                continue
+            contains = False
+            for node, parent, conditional in occurrences:
+                after = bisect_right(starts, index[id(node)])
+                if after < len(starts) and starts[after] <= last[id(node)]:
+                    contains = True
+                    break
+            if contains:
+                continue
+
+            temp = f".cse{next(self.temps)}"
+            temps.append(temp)
+            (first, parent, conditional), *rest = occurrences
+            insort(starts, index[id(first)])
+            named = ast.NamedExpr(ast.Name(temp, ast.Store()), first)
+            replace_child(parent, first, ast.copy_location(named, first))
+            for node, parent, conditional in rest:
+                insort(starts, index[id(node)])
+                for x in range(index[id(node)] + 1, last[id(node)] + 1):
+                    gone[x] = True
+                replace_child(parent, node, ast.copy_location(ast.Name(temp, ast.Load()), node))
+            self.reused += len(rest)
+
+        if not temps:
+            return statement
+        return [statement, delete_temps(temps, statement)]
+
+
 class Compiler:
-    def __init__(self):
+    # AST node type -> `visit_*` method, filled in as each type is first compiled
+    handlers = {}
+
+    # AST comparison operator type -> COMPARE_OP oparg
+    COMPARISONS = {
+        ast.Lt: 0,
+        ast.LtE: 1,
+        ast.Eq: 2,
+        ast.NotEq: 3,
+        ast.Gt: 4,
+        ast.GtE: 5,
+        ast.Is: 6,
+        ast.IsNot: 7,
+        ast.In: 8,
+        ast.NotIn: 9,
+    }
+
+    # Yielded by handlers to compile `test` as a jump to `marker` if its truth is
+    # `condition`, see `visit_JumpIf`
+    JumpIf = namedtuple("JumpIf", "test marker condition")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.handlers = {}
+
+    def __init__(self, peephole=True, slots=False, superinstructions=True):
         self.names = defaultdict(count().__next__)
         self.consts = defaultdict(count().__next__)
-        self.code = []
-        self.labels = {}
+        self.code = []  # List of [opcode, oparg], the oparg of a jump is its marker
+        self.lines = []  # Source line of each instruction in `code`
+        self.lineno = 0  # Line of the node being compiled, see `visit`
+        self.labels = {}  # Marker -> index of the instruction it points to
+        self.peephole = peephole
+        self.peephole_removed = 0
+        # Keep variables in slots indexed by their name's number, rather than in a dict
+        self.slots = slots
+        # Fuse common instruction sequences into one instruction
+        self.superinstructions = superinstructions
+        self.fused = 0
 
     def build(self):
         """ Return a `Code` object
         Convert attribute list of opcodes to bytecode
         """
-        for x in range(len(self.code)):
-            # If the item is a marker (represented by an object that is not an integer)
-            if not isinstance(self.code[x], int):
-                # Assign the marker (the arg in a jump argument) to be the location to jump to
-                self.code[x] = self.labels[self.code[x]]
+        if self.peephole:
+            self.peephole_removed = self.optimize_peephole()
+        if self.superinstructions:
+            self.fused = self.fuse_superinstructions()
+
+        # Number of [opcode, oparg] units each instruction takes, counting EXTENDED_ARG prefixes.
+        # A jump's size depends on where its target ends up, so jumps start at one
+        # unit and are widened until every target fits in its jump's oparg
+        sizes = [
+            1 if opcode in HASJUMP else len(self.encode_arg(oparg))
+            for opcode, oparg in self.code
+        ]
+        while True:
+            positions = list(accumulate(sizes, initial=0))
+            widened = False
+            for x, (opcode, oparg) in enumerate(self.code):
+                if opcode in HASJUMP:
+                    size = len(self.encode_arg(positions[self.labels[oparg]]))
+                    if size > sizes[x]:
+                        sizes[x] = size
+                        widened = True
+            if not widened:
+                break
+
+        code = []
+        for (opcode, oparg), size in zip(self.code, sizes):
+            if opcode in HASJUMP:
+                # The marker (the arg in a jump argument) becomes the location to jump to
+                oparg = positions[self.labels[oparg]]
+            opbytes = self.encode_arg(oparg, size)
+            for b in opbytes[:-1]:
+                code += (OPCODES["EXTENDED_ARG"], b)
+            ## Operating on the bottom byte
+            code += (opcode, opbytes[-1])
 
         return Code(
-            tuple(self.names), tuple(v for t, v in self.consts), bytes(self.code)
+            tuple(self.names),
+            tuple(const for const_type, const, key in self.consts),
+            bytes(code),
+            self.max_stack_depth(),
+            self.encode_lines(self.lines),
         )
 
-    def add_name(self, name) -> int:
-        return self.names[name]
-
-    def add_const(self, const) -> int:
-        return self.consts[type(const), const]
+    def max_stack_depth(self) -> int:
+        """ Return the deepest the value stack can get running the instruction list """
+        jump = OPCODES["JUMP"]
+        # Stack depth on entry to each visited instruction
+        depths = [None] * len(self.code)
+        todo = [(0, 0)]
+        max_depth = 0
+        while todo:
+            x, depth = todo.pop()
+            while x < len(self.code) and depths[x] is None:
+                depths[x] = depth
+                opcode, oparg = self.code[x]
+                if opcode in HASJUMP:
+                    todo.append(
+                        (self.labels[oparg], depth + stack_effect(opcode, oparg, jump=True))
+                    )
+                depth += stack_effect(opcode, oparg)
+                max_depth = max(max_depth, depth)
+                if opcode == jump:
+                    break
+                x += 1
+        return max_depth
+
+    @staticmethod
+    def encode_arg(oparg, size=1):
+        """ Return the bytes of an oparg, from greatest to least, padded to at least `size`.
+        All but the last are emitted as EXTENDED_ARG prefixes
+        """
+        opbytes = [oparg & 255]
+        oparg >>= 8
+        while oparg or len(opbytes) < size:
+            opbytes.append(oparg & 255)
+            oparg >>= 8
+        return opbytes[::-1]
 
-    def emit(self, opname, oparg):
+    @staticmethod
+    def encode_lines(lines) -> bytes:
+        """ Return the line table of `Code` for the source line of each instruction.
+        A change of more than a byte's worth of instructions or lines takes several pairs.
         """
+        table = bytearray()
+        last_x = last_line = 0
+        for x, line in enumerate(lines):
+            if line == last_line:
+                continue
+            delta, line_delta = x - last_x, line - last_line
+            while delta > 255:
+                table.extend((255, 0))
+                delta -= 255
+            while not -128 <= line_delta <= 127:
+                step = 127 if line_delta > 0 else -128
+                table.extend((delta, step & 255))
+                delta = 0
+                line_delta -= step
+            table.extend((delta, line_delta & 255))
+            last_x, last_line = x, line
+        return bytes(table)
+
+    def optimize_peephole(self) -> int:
+        """ Simplify the instruction list before labels are resolved.
+        Return the number of instructions removed.
+          - Jumps to an unconditional JUMP go straight to its target
+          - Code after a JUMP is removed up to the next jump target
+          - A JUMP to the next instruction is removed
+          - LOAD_CONST/DUP_TOP followed by POP_TOP is removed
+          - DUP_TOP; STORE_NAME x; POP_TOP becomes STORE_NAME x
+          - STORE_NAME x; LOAD_NAME x becomes DUP_TOP; STORE_NAME x
+        The STORE_NAME patterns apply to STORE_FAST/LOAD_FAST too.
         """
-        # Appending two items to the end of the list, not a tuple
-
-        # Getting a list of bytes in the oparg, from least to greatest
-        opbytes = []
-        while oparg:
-            opbytes.append(oparg & 255)
-            oparg = oparg >> 8
+        jump = OPCODES["JUMP"]
+        pop_top = OPCODES["POP_TOP"]
+        dup_top = OPCODES["DUP_TOP"]
+        removable = {OPCODES["LOAD_CONST"], dup_top}
+        # Store opcode -> matching load opcode
+        loads = {
+            OPCODES["STORE_NAME"]: OPCODES["LOAD_NAME"],
+            OPCODES["STORE_FAST"]: OPCODES["LOAD_FAST"],
+        }
+        code = self.code
+        lines = self.lines
+        before = len(code)
+
+        changed = True
+        while changed:
+            changed = False
+
+            # Thread jumps through unconditional jumps
+            for x, instruction in enumerate(code):
+                if instruction[0] not in HASJUMP:
+                    continue
+                seen = set()
+                target = self.labels[instruction[1]]
+                while (
+                    target < len(code) and code[target][0] == jump and target not in seen
+                ):
+                    seen.add(target)
+                    instruction[1] = code[target][1]
+                    if instruction[0] == jump:
+                        # It now stands for the jump it goes through, like a loop's back
+                        # edge, which may be removed as dead code after it
+                        lines[x] = lines[target]
+                    target = self.labels[instruction[1]]
+
+            targets = {
+                self.labels[oparg] for opcode, oparg in code if opcode in HASJUMP
+            }
+            keep = [True] * len(code)
+            x = 0
+            while x < len(code):
+                opcode, oparg = code[x]
+                following = code[x + 1] if x + 1 < len(code) else None
+                # Only patterns that nothing jumps into the middle of can be changed
+                if following is None or x + 1 in targets:
+                    pass
+                elif opcode in removable and following[0] == pop_top:
+                    keep[x] = keep[x + 1] = False
+                    x += 2
+                    continue
+                elif (
+                    opcode == dup_top
+                    and following[0] in loads
+                    and x + 2 < len(code)
+                    and code[x + 2][0] == pop_top
+                    and x + 2 not in targets
+                ):
+                    keep[x] = keep[x + 2] = False
+                    x += 3
+                    continue
+                elif opcode in loads and following == [loads[opcode], oparg]:
+                    code[x] = [dup_top, 0]
+                    code[x + 1] = [opcode, oparg]
+                    lines[x + 1] = lines[x]
+                    changed = True
+
+                if opcode == jump:
+                    if self.labels[oparg] == x + 1:
+                        keep[x] = False
+                    # Nothing runs between a JUMP and the next jump target
+                    x += 1
+                    while x < len(code) and x not in targets:
+                        keep[x] = False
+                        x += 1
+                    continue
+                x += 1
+
+            if not all(keep):
+                changed = True
+                # Index of each old instruction in the new list, and of the end of code
+                new_index = list(accumulate(keep, initial=0))
+                self.labels = {
+                    marker: new_index[index] for marker, index in self.labels.items()
+                }
+                code = [instruction for instruction, k in zip(code, keep) if k]
+                lines = [line for line, k in zip(lines, keep) if k]
+
+        self.code = code
+        self.lines = lines
+        return before - len(code)
+
+    def fuse_superinstructions(self) -> int:
+        """ Replace common instruction sequences by a single superinstruction.
+        Return the number of instructions removed.
+        The sequences are the most frequent opcode pairs on the bench_curvy.py workloads
+        (see `VirtualMachine.instrumentation_report`):
+          - LOAD_NAME x; LOAD_CONST c; BINARY_* becomes BINARY_OP_NAME_CONST
+          - ... followed by STORE_NAME x becomes INPLACE_OP_NAME_CONST
+          - LOAD_NAME x; LOAD_NAME y becomes LOAD_NAME_NAME
+        and the same for variable slots.
+          - COMPARE_OP <; POP_JUMP_IF_FALSE becomes POP_JUMP_IF_NOT_LT, and the same for
+            the other rich comparisons, like the test of `while i < n`
+        """
+        # Load opcode -> (store opcode, binary op, in-place op, load pair)
+        fusions = {
+            OPCODES["LOAD_NAME"]: (
+                OPCODES["STORE_NAME"],
+                OPCODES["BINARY_OP_NAME_CONST"],
+                OPCODES["INPLACE_OP_NAME_CONST"],
+                OPCODES["LOAD_NAME_NAME"],
+            ),
+            OPCODES["LOAD_FAST"]: (
+                OPCODES["STORE_FAST"],
+                OPCODES["BINARY_OP_FAST_CONST"],
+                OPCODES["INPLACE_OP_FAST_CONST"],
+                OPCODES["LOAD_FAST_FAST"],
+            ),
+        }
+        load_const = OPCODES["LOAD_CONST"]
+        compare_op = OPCODES["COMPARE_OP"]
+        pop_jump_if_false = OPCODES["POP_JUMP_IF_FALSE"]
+        # COMPARE_OP oparg -> the opcode fusing it with POP_JUMP_IF_FALSE
+        compare_jumps = {oparg: opcode for opcode, oparg in COMPARE_JUMPS.items()}
+        targets = {self.labels[oparg] for opcode, oparg in self.code if opcode in HASJUMP}
+        old = self.code + [[None, None]] * 3
+
+        code = []
+        lines = []
+        # Index of each old instruction in the new list
+        new_index = []
+        x = 0
+        while x < len(self.code):
+            opcode, oparg = old[x]
+            instruction, length = [opcode, oparg], 1
+            if opcode in fusions:
+                store, binary, inplace, load_pair = fusions[opcode]
+                if (
+                    old[x + 1][0] == load_const
+                    and old[x + 2][0] in BINARY_OPERATORS
+                    and old[x + 1][1] < 1 << 16
+                    and x + 1 not in targets
+                    and x + 2 not in targets
+                ):
+                    packed = oparg << 24 | old[x + 1][1] << 8 | old[x + 2][0]
+                    if old[x + 3] == [store, oparg] and x + 3 not in targets:
+                        instruction, length = [inplace, packed], 4
+                    else:
+                        instruction, length = [binary, packed], 3
+                elif (
+                    old[x + 1][0] == opcode
+                    and old[x + 1][1] < 1 << 16
+                    and x + 1 not in targets
+                ):
+                    instruction, length = [load_pair, oparg << 16 | old[x + 1][1]], 2
+            elif (
+                opcode == compare_op
+                and oparg in compare_jumps
+                and old[x + 1][0] == pop_jump_if_false
+                and x + 1 not in targets
+            ):
+                instruction, length = [compare_jumps[oparg], old[x + 1][1]], 2
+
+            new_index += [len(code)] * length
+            code.append(instruction)
+            lines.append(self.lines[x])
+            x += length
+        new_index.append(len(code))
+
+        self.labels = {marker: new_index[index] for marker, index in self.labels.items()}
+        self.code = code
+        self.lines = lines
+        return len(new_index) - 1 - len(code)
 
-        for b in opbytes[:0:-1]:
-            self.code += (OPCODES["EXTENDED_ARG"], b)
+    def add_name(self, name) -> int:
+        return self.names[name]
 
-        if not opbytes:
-            opbytes = [0]
+    def add_const(self, const) -> int:
+        # 0.0 == -0.0 and (1,) == (1.0,), so these are keyed by their repr too
+        if isinstance(const, (float, complex, tuple)):
+            return self.consts[type(const), const, repr(const)]
+        return self.consts[type(const), const, None]
 
-        ## Operating on the bottom byte
-        self.code += (OPCODES[opname], opbytes[0])
+    def emit(self, opname, oparg):
+        self.code.append([OPCODES[opname], oparg])
+        self.lines.append(self.lineno)
 
     def emit_jump(self, opname, marker):
-        self.code += (OPCODES[opname], marker)
+        self.code.append([OPCODES[opname], marker])
+        self.lines.append(self.lineno)
 
     def label(self, marker):
         # Set a marker for a jump at the current position in the code.
         # Set marker in self.labels
         assert marker not in self.labels
-        self.labels[marker] = len(self.code) // 2
+        self.labels[marker] = len(self.code)
 
     def visit(self, nodes):
+        """ Visit every AST node in list nodes, calling `visit_[node]` on each.
+        Handlers of nodes with children are generators yielding each child node (or list
+        of nodes) when its code should be emitted. They are resumed from an explicit stack
+        rather than by recursion, so nesting depth is only limited by memory.
+        Code is emitted on the line of the innermost node being compiled that has one.
         """
-        Visit every AST node in list nodes. Call self.visit_[node] """
-        if not isinstance(nodes, list):
-            nodes = [nodes]
-
-        for n in nodes:
-            handler = getattr(self, f"visit_{n.__class__.__name__}")
-            handler(n)
+        handlers = self.handlers
+        todo = [iter(nodes if isinstance(nodes, list) else [nodes])]
+        # Line of each handler on `todo`, to go back to when it is resumed
+        lines = [self.lineno]
+        while todo:
+            for node in todo[-1]:
+                if isinstance(node, list):
+                    todo.append(iter(node))
+                    lines.append(lines[-1])
+                    break
+                self.lineno = getattr(node, "lineno", None) or lines[-1]
+                handler = handlers.get(type(node)) or self.add_handler(type(node))
+                children = handler(self, node)
+                if children is not None:
+                    todo.append(children)
+                    lines.append(self.lineno)
+                    break
+                self.lineno = lines[-1]
+            else:
+                todo.pop()
+                lines.pop()
+                if lines:
+                    self.lineno = lines[-1]
+
+    @classmethod
+    def add_handler(cls, node_type):
+        """ Look up the `visit_*` method for an AST node type and cache it in `handlers` """
+        handler = cls.handlers[node_type] = getattr(cls, f"visit_{node_type.__name__}")
+        return handler
 
     def visit_Module(self, node):
         # For compiling a module
         for child in node.body:
-            self.visit(child)
+            yield child
 
     def visit_Interactive(self, node): # pragma: no cover
         # For compiling an interactive interpreter
         for child in node.body:
-            self.visit(child)
+            yield child
 
     def visit_Expr(self, node):
-        self.visit(node.value)
+        yield node.value
         self.emit("PRINT_EXPR", 0)
 
     def visit_Assign(self, node):
-        self.visit(node.value)
+        yield node.value
         assert node.targets, "need at least one target!"
         for target in node.targets[:-1]:
             self.emit("DUP_TOP", 0)
-            self.visit(target)
-        self.visit(node.targets[-1])
+            yield target
+        yield node.targets[-1]
+
+    def visit_NamedExpr(self, node):
+        yield node.value
+        self.emit("DUP_TOP", 0)
+        yield node.target
 
     def visit_Constant(self, node):
         self.emit("LOAD_CONST", self.add_const(node.value))
@@ -210,41 +1641,41 @@ class Compiler:
     def visit_Name(self, node):
         oparg = self.add_name(node.id)
         if isinstance(node.ctx, ast.Store):
-            self.emit("STORE_NAME", oparg)
+            self.emit("STORE_FAST" if self.slots else "STORE_NAME", oparg)
         elif isinstance(node.ctx, ast.Load):
-            self.emit("LOAD_NAME", oparg)
+            self.emit("LOAD_FAST" if self.slots else "LOAD_NAME", oparg)
         else:
             assert False, node.ctx  # pragma: no cover
 
     def visit_Delete(self, node):
         for target in node.targets:
-            self.emit("DEL_NAME", self.add_name(target.id))
+            self.emit("DEL_FAST" if self.slots else "DEL_NAME", self.add_name(target.id))
 
     def visit_Tuple(self, node):
         for child in node.elts:
-            self.visit(child)
+            yield child
         self.emit("BUILD_TUPLE", len(node.elts))
 
     def visit_List(self, node):
         for child in node.elts:
-            self.visit(child)
+            yield child
         self.emit("BUILD_LIST", len(node.elts))
 
     def visit_Set(self, node):
         for child in node.elts:
-            self.visit(child)
+            yield child
         self.emit("BUILD_SET", len(node.elts))
 
     def visit_Dict(self, node):
         for x in range(len(node.keys)):
-            self.visit(node.values[x])
-            self.visit(node.keys[x])
+            yield node.values[x]
+            yield node.keys[x]
         self.emit("BUILD_DICT", len(node.keys))
 
     def visit_BinOp(self, node):
-        self.visit(node.left)
-        self.visit(node.right)
-        self.visit(node.op)
+        yield node.left
+        yield node.right
+        yield node.op
 
     def visit_Add(self, node):
         self.emit("BINARY_ADD", 0)
@@ -283,8 +1714,8 @@ class Compiler:
         self.emit("RSHIFT", 0)
 
     def visit_UnaryOp(self, node):
-        self.visit(node.operand)
-        self.visit(node.op)
+        yield node.operand
+        yield node.op
 
     def visit_UAdd(self, node):
         self.emit("UNARY_ADD", 0)
@@ -300,276 +1731,2164 @@ class Compiler:
 
     def visit_AugAssign(self, node):
         # Loading value from name
-        self.visit(ast.Name(node.target.id, ast.Load()))
+        yield ast.Name(node.target.id, ast.Load())
         # Operating
-        self.visit(node.value)
-        self.visit(node.op)
+        yield node.value
+        yield node.op
         # Storing value
-        self.visit(ast.Name(node.target.id, ast.Store()))
+        yield ast.Name(node.target.id, ast.Store())
 
     def visit_Subscript(self, node):
-        self.visit(node.value)
-        self.visit(node.slice)
+        yield node.value
+        yield node.slice
+        # Python 3.9+ no longer wraps the slice in an `ast.Index` node
+        if not isinstance(node.slice, getattr(ast, "Index", ())):
+            self.emit("INDEX", 0)
 
     def visit_Index(self, node):
-        self.visit(node.value)
+        yield node.value
         self.emit("INDEX", 0)
 
+    def visit_Compare(self, node):
+        mark_cleanup = object()
+        mark_end = object()
+        yield node.left
+        for x, (op, comparator) in enumerate(zip(node.ops, node.comparators)):
+            yield comparator
+            if x == len(node.ops) - 1:
+                self.emit("COMPARE_OP", self.COMPARISONS[type(op)])
+                break
+            # `a < b < c`: keep a copy of b under the result, to compare with c
+            self.emit("DUP_TOP", 0)
+            self.emit("ROT_THREE", 0)
+            self.emit("COMPARE_OP", self.COMPARISONS[type(op)])
+            self.emit_jump("JUMP_IF_FALSE_OR_POP", mark_cleanup)
+        if len(node.ops) > 1:
+            self.emit_jump("JUMP", mark_end)
+            self.label(mark_cleanup)
+            # Drop the copy from under the false result
+            self.emit("ROT_TWO", 0)
+            self.emit("POP_TOP", 0)
+            self.label(mark_end)
+
+    def visit_BoolOp(self, node):
+        mark_end = object()
+        if isinstance(node.op, ast.And):
+            jump = "JUMP_IF_FALSE_OR_POP"
+        else:
+            jump = "JUMP_IF_TRUE_OR_POP"
+        for value in node.values[:-1]:
+            yield value
+            self.emit_jump(jump, mark_end)
+        yield node.values[-1]
+        self.label(mark_end)
+
+    def visit_JumpIf(self, jump):
+        """ Compile a test that jumps without leaving a value on the stack. `not`, `and`
+        and `or` jump on their operands directly rather than computing a bool to test
+        """
+        test, marker, condition = jump
+        if isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not):
+            yield self.JumpIf(test.operand, marker, not condition)
+        elif isinstance(test, ast.BoolOp):
+            if isinstance(test.op, ast.And) != condition:
+                # `and` is false as soon as a value is, and `or` true as soon as one is
+                for value in test.values:
+                    yield self.JumpIf(value, marker, condition)
+            else:
+                # Otherwise only the last value decides, once the others skip past it
+                mark_skip = object()
+                for value in test.values[:-1]:
+                    yield self.JumpIf(value, mark_skip, not condition)
+                yield self.JumpIf(test.values[-1], marker, condition)
+                self.label(mark_skip)
+        else:
+            yield test
+            self.emit_jump("POP_JUMP_IF_TRUE" if condition else "POP_JUMP_IF_FALSE", marker)
+
     def visit_IfExp(self, node):
         mark_else = object()
         mark_end = object()
         # test, body, orelse
-        self.visit(node.test)
-        self.emit_jump("JUMP_IF_FALSE", mark_else)
-        self.emit("POP_TOP", 0)
-        self.visit(node.body)
+        yield self.JumpIf(node.test, mark_else, False)
+        yield node.body
         self.emit_jump("JUMP", mark_end)
         self.label(mark_else)
-        self.emit("POP_TOP", 0)
-        self.visit(node.orelse)
+        yield node.orelse
         self.label(mark_end)
 
     def visit_If(self, node):
-        self.visit_IfExp(node)
+        return self.visit_IfExp(node)
 
     def visit_While(self, node):
         mark_loop = object()
         mark_end = object()
+        if isinstance(node.test, ast.Constant) and node.test.value:
+            # `while 1:` never exits through its test, so don't evaluate one
+            self.label(mark_loop)
+            yield node.body
+            self.emit_jump("JUMP", mark_loop)
+            return
+
         self.label(mark_loop)
-        self.visit(node.test)
-        self.emit_jump("JUMP_IF_FALSE", mark_end)
-        self.emit("POP_TOP", 0)
-        self.visit(node.body)
+        yield self.JumpIf(node.test, mark_end, False)
+        yield node.body
         self.emit_jump("JUMP", mark_loop)
         self.label(mark_end)
-        self.emit("POP_TOP", 0)
 
     def visit_For(self, node):
         assert not node.orelse, "we don't support this."
         mark_loop = object()
         mark_end = object()
 
-        self.visit(node.iter) # for a in b<<
+        if self.is_range_call(node.iter):
+            # for a in range(b): counts with an int on the stack instead of an iterator
+            yield node.iter.func
+            yield node.iter.args
+            self.emit("GET_RANGE_ITER", len(node.iter.args))
+            self.label(mark_loop)
+            self.emit_jump("FOR_RANGE", mark_end)
+            yield node.target
+            yield node.body
+            self.emit_jump("JUMP", mark_loop)
+            self.label(mark_end)
+            # Taking care of the counter and bound on the stack
+            self.emit("POP_TOP", 0)
+            self.emit("POP_TOP", 0)
+            return
+
+        yield node.iter # for a in b<<
         self.emit("GET_ITER", 0)
         self.label(mark_loop)
         self.emit_jump("FOR_ITER", mark_end)
-        self.visit(node.target) # for a<< in b
-        self.visit(node.body) # the code in the loop
+        yield node.target # for a<< in b
+        yield node.body # the code in the loop
         self.emit_jump("JUMP", mark_loop)
         self.label(mark_end)
         self.emit("POP_TOP", 0) # Taking care of the empty iter on the stack
 
+    @staticmethod
+    def is_range_call(node) -> bool:
+        """ Whether node is a call to `range` with a stop, or a start and stop """
+        return (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "range"
+            and 1 <= len(node.args) <= 2
+            and not node.keywords
+            and not any(isinstance(arg, ast.Starred) for arg in node.args)
+        )
+
     def visit_Pass(self, node):
         pass
 
     def visit_Call(self, node):
-        self.visit(node.func)
-        self.visit(node.args)
+        yield node.func
+        yield node.args
         self.emit("CALL_FUNCTION", len(node.args))
 
+class ResourceLimitExceeded(Exception):
+    """ Raised when code goes over one of its VirtualMachine's limits """
+
+    def __init__(self, message, pc):
+        super().__init__(message, pc)
+        self.pc = pc  # The instruction that went over the limit
+
+    def __str__(self):
+        return f"{self.args[0]} at pc {self.pc}"
+
+
+class Snapshot:
+    """ The globals of a VirtualMachine at one point, to start new VMs from.
+    Every VM started from the snapshot gets its own copy of each mutable value, so
+    changing a container in place, like `getattr(table, "append")(1)`, is only seen
+    by that VM. Immutable values are shared, and containers only holding immutable
+    values are copied shallowly, which is much faster than `copy.deepcopy`. Values
+    that can't be copied, like open files, are shared.
+    """
+
+    # Types of the values that are never copied, as nothing can change them
+    IMMUTABLE = frozenset({int, float, complex, str, bytes, bool, type(None), range})
+
+    def __init__(self, globals):
+        # Name -> function copying its value, for the values that aren't immutable
+        self.copiers = {}
+        self.globals = {}
+        for name, value in globals.items():
+            copier = self.copier(value)
+            if copier is not None:
+                self.copiers[name] = copier
+                value = copier(value)
+            self.globals[name] = value
+
+    @classmethod
+    def copier(cls, value):
+        """ Return a function copying `value`, or None if it's immutable """
+        immutable = cls.IMMUTABLE
+        value_type = type(value)
+        if value_type in immutable:
+            return None
+        if value_type in (tuple, frozenset, list, set, bytearray):
+            if all(type(item) in immutable for item in value):
+                return None if value_type in (tuple, frozenset) else value_type
+        elif value_type is dict:
+            if all(
+                type(key) in immutable and type(item) in immutable
+                for key, item in value.items()
+            ):
+                return dict
+        return cls.deepcopy
+
+    @staticmethod
+    def deepcopy(value):
+        try:
+            return copy.deepcopy(value)
+        except Exception:
+            return value
+
+    def restore(self) -> dict:
+        """ Return a new globals dict with a copy of the snapshot's contents """
+        restored = dict(self.globals)
+        for name, copier in self.copiers.items():
+            restored[name] = copier(restored[name])
+        return restored
+
+    def fork(self, **vm_options):
+        """ Return a new VirtualMachine, created with `vm_options`, starting from the snapshot """
+        vm = VirtualMachine(**vm_options)
+        vm.globals = self.restore()
+        return vm
+
+
 class VirtualMachine:
-    def __init__(self):
-        self.stack = []
+    def __init__(
+        self,
+        slots=False,
+        instrument=False,
+        timing=False,
+        adaptive=False,
+        max_instructions=None,
+        timeout=None,
+        max_size=None,
+        engine="loop",
+        jit=False,
+    ):
+        if engine not in ("loop", "closure"):
+            raise ValueError(f"unknown engine {engine!r}")
+        if engine == "closure" and (instrument or timing or adaptive or jit):
+            raise ValueError("instrumentation, adaptive mode and jit need the 'loop' engine")
+        if jit and (instrument or timing):
+            raise ValueError("compiled loops can't be instrumented")
+        # Shared by every run of the VM, unless given its own globals
         self.globals = {}
+        # Compile with variable slots, see `Compiler(slots=True)`
+        self.slots = slots
         self.builtins = vars(builtins)
         self.builtins["__name__"] = "__main__"
-        self.bytecode = None
-        self.oparg = 0
-        self.pc = 0
+        # Frames of the code running on the VM, by id of the thread that started them.
+        # Everything that changes while code runs lives in its Frame, so the VM and the
+        # Code can be shared between threads.
+        self.frames = {}
+        # Rewrite generic arithmetic into type-specialized opcodes as the code runs
+        self.adaptive = adaptive
+        self.specialized_hits = 0  # Specialized instructions whose type guard held
+        self.specialized_misses = 0  # Specialized instructions deoptimized by their guard
+        self.generic_runs = 0  # Generic arithmetic instructions run in adaptive mode
+        self.specializations = 0  # Instructions rewritten into a specialized form
+
+        # Limits for each run, for untrusted code. They are only checked by the handlers
+        # for backward jumps, building containers, calls and container arithmetic, which
+        # replace the normal ones when a limit is set, so straight-line code runs unchecked.
+        self.max_instructions = max_instructions
+        self.timeout = timeout  # Seconds of wall-clock time
+        self.max_size = max_size  # Length of any container built, and of the stack
+        self.limited = not (max_instructions is None and timeout is None and max_size is None)
+        if jit and self.limited:
+            raise ValueError("compiled loops don't check limits")
+
+        # Compile loops to Python functions once they are hot, see `LoopCompiler`
+        self.jit = jit
+        # Code -> {loop header: times jumped back to so far, then its function or None}
+        self.jit_loops = weakref.WeakKeyDictionary()
+        self.loops_compiled = 0
+        self.loop_runs = 0  # Calls to compiled loops
+        self.guard_exits = 0  # Calls that returned to the interpreter at the loop header
+        self.loop_time = 0  # Nanoseconds spent in compiled loops
+
+        # `Frame` handlers indexed by opcode, so `run` never has to look them up by name
+        self.dispatch = self.build_dispatch()
+
+        # Instrumentation gets its own loop, so it costs nothing when it's off.
+        self.bytecode = None  # Code of the last run
+        # Execution count of each instruction of the last run, indexed by pc
+        self.counts = []
+        # Execution count of each pair of consecutive opcodes, when only counting
+        self.pairs = []
+        # Nanoseconds spent in each opcode's handler during the last run, indexed by opcode
+        self.times = []
+        if timing:
+            self.execute = Frame.execute_timed
+        elif instrument:
+            self.execute = Frame.execute_counted
+        else:
+            self.execute = Frame.execute
+        self.step = Frame.step
+
+        # The "loop" engine runs decoded instructions through `dispatch`. The "closure"
+        # engine first translates each Code into closures, see `ClosureTranslator`.
+        self.engine = engine
+        self.closures = weakref.WeakKeyDictionary()  # Code -> its closures
+        if engine == "closure":
+            self.execute = Frame.execute_closures
+            self.step = Frame.step_closures
+
+    def build_dispatch(self):
+        """ Return a list of `Frame.visit_*` functions, indexed by opcode.
+        They are called with the running frame and the oparg.
+        EXTENDED_ARG has no handler, it is folded into the next oparg by `Code.decode`.
+        """
+        dispatch = [
+            getattr(Frame, f"visit_{opname}", None) for opname in OPNAMES
+        ]
+        if self.limited:
+            dispatch[OPCODES["JUMP"]] = Frame.limited_JUMP
+            dispatch[OPCODES["CALL_FUNCTION"]] = Frame.limited_CALL_FUNCTION
+            for opname in ("BUILD_LIST", "BUILD_TUPLE", "BUILD_SET", "BUILD_DICT"):
+                dispatch[OPCODES[opname]] = self.limited_build(dispatch[OPCODES[opname]])
+            for opname in ("BINARY_ADD", "BINARY_MUL"):
+                dispatch[OPCODES[opname]] = self.limited_binary(OPCODES[opname])
+            for opcode in CONDITIONAL_JUMPS:
+                dispatch[opcode] = self.conditional_back_edge(
+                    dispatch[opcode], Frame.limited_JUMP
+                )
+        if self.jit:
+            dispatch[OPCODES["JUMP"]] = Frame.jit_JUMP
+            for opcode in CONDITIONAL_JUMPS:
+                dispatch[opcode] = self.conditional_back_edge(dispatch[opcode], Frame.jit_JUMP)
+        if self.adaptive:
+            for generic in SPECIALIZATIONS:
+                dispatch[generic] = self.adaptive_handler(generic, dispatch[generic])
+        return dispatch
+
+    def adaptive_handler(self, generic, handler):
+        """ Return a handler for the generic arithmetic opcode that counts, in the decoded
+        instruction's oparg, how many times in a row it ran on two operands of the same
+        specializable type. After ADAPTIVE_WARMUP runs the instruction is rewritten in
+        place into the opcode specialized for that type.
+        """
+        variants = SPECIALIZATIONS[generic]
+
+        def adaptive(frame, oparg):
+            stack = frame.stack
+            operand_type = type(stack[frame.sp - 1])
+            same_type = type(stack[frame.sp - 2]) is operand_type
+            handler(frame, oparg)
+            self.generic_runs += 1
+            code = frame.code
+            if same_type and operand_type in variants:
+                if oparg < ADAPTIVE_WARMUP:
+                    code[frame.pc - 1] = (generic, oparg + 1)
+                else:
+                    code[frame.pc - 1] = (variants[operand_type], 0)
+                    self.specializations += 1
+            elif oparg:
+                code[frame.pc - 1] = (generic, 0)
+
+        return adaptive
+
+    def limited_build(self, handler):
+        """ Wrap a BUILD_* handler, checking how many items it builds from """
+
+        def limited(frame, oparg):
+            if self.max_size is not None and oparg > self.max_size:
+                raise ResourceLimitExceeded("container size limit exceeded", frame.pc - 1)
+            handler(frame, oparg)
+
+        return limited
+
+    def limited_binary(self, opcode):
+        """ Return a handler for a binary opcode that runs the frame's limited operation """
+
+        def limited(frame, oparg):
+            stack = frame.stack
+            sp = frame.sp = frame.sp - 1
+            stack[sp - 1] = frame.binary_operators[opcode](stack[sp - 1], stack[sp])
+
+        return limited
+
+    def conditional_back_edge(self, handler, back_edge):
+        """ Wrap a conditional jump's handler so that jumping backward runs `back_edge`,
+        the handler of JUMP, instead. Jump threading can make the jump at the end of an
+        `if` in a loop, or the exit of an inner loop, a back edge of the loop.
+        """
 
-    def run(self, bytecode):
+        def jump(frame, oparg):
+            pc = frame.pc
+            handler(frame, oparg)
+            if oparg < pc and frame.pc == oparg:
+                frame.pc = pc
+                back_edge(frame, oparg)
+
+        return jump
+
+    def hot_loop(self, frame, header):
+        """ Count a backward jump of the frame to `header`.
+        Return the compiled loop once it is hot, or None to keep interpreting it.
+        """
+        loops = self.jit_loops.get(frame.bytecode)
+        if loops is None:
+            loops = self.jit_loops[frame.bytecode] = {}
+        state = loops.get(header, 0)
+        if type(state) is not int:
+            return state
+        if state < JIT_THRESHOLD:
+            loops[header] = state + 1
+            return None
+        loop = loops[header] = LoopCompiler(
+            frame.bytecode, header, frame.pc - 1, frame.sp
+        ).compile(frame)
+        if loop is not None:
+            self.loops_compiled += 1
+        return loop
+
+    def jit_report(self) -> dict:
+        """ Return how many loops were compiled and how they ran, across every run of this VM """
+        return {
+            "compiled": self.loops_compiled,
+            "runs": self.loop_runs,
+            "guard_exits": self.guard_exits,
+            "time": self.loop_time / 1e9,
+        }
+
+    def snapshot(self):
+        """ Return a Snapshot of the VM's globals, to fork warmed-up VMs from """
+        return Snapshot(self.globals)
+
+    def specialization_report(self) -> dict:
+        """ Return how often arithmetic ran specialized, across every run of this VM.
+        Deoptimized instructions count as misses, and as generic runs.
+        """
+        total = self.specialized_hits + self.generic_runs
+        return {
+            "hits": self.specialized_hits,
+            "misses": self.specialized_misses,
+            "generic": self.generic_runs,
+            "specializations": self.specializations,
+            "hit_rate": self.specialized_hits / total if total else 0.0,
+        }
+
+    def run(self, bytecode, globals=None):
+        """ Run `bytecode` in the VM's globals, or in `globals` if given.
+        Safe to call from several threads at once, each run gets its own Frame.
+        """
+        frame = self.start(bytecode, globals)
+        try:
+            self.execute(frame)
+        finally:
+            self.finish(frame)
+
+        assert frame.sp == 0, "stack should be empty!"
+
+    def start(self, bytecode, globals=None):
+        """ Return a new Frame set up to run `bytecode` from the start """
+        frame = Frame(self, bytecode, self.globals if globals is None else globals)
+        if self.limited:
+            if self.timeout is not None:
+                frame.deadline = time.monotonic() + self.timeout
+            if self.max_size is not None and bytecode.stacksize > self.max_size:
+                raise ResourceLimitExceeded("stack size limit exceeded", 0)
+            # The Optimizer folds small constant expressions like `"ab" * 600`
+            for const in bytecode.consts:
+                frame.check_size(const, 0)
+        if bytecode.uses_slots:
+            frame.fastlocals = [frame.globals.get(name, UNBOUND) for name in bytecode.names]
+        if self.engine == "closure":
+            frame.op = self.translate(bytecode)[0]
+        self.frames[threading.get_ident()] = frame
+        return frame
+
+    def translate(self, bytecode):
+        """ Return the closures of `bytecode`, translating it the first time this VM runs it """
+        ops = self.closures.get(bytecode)
+        if ops is None:
+            ops = self.closures[bytecode] = ClosureTranslator(self, bytecode).translate()
+        return ops
+
+    def finish(self, frame):
+        """ Called when a frame returned by `start` stops running, normally or not """
+        if frame.bytecode.uses_slots:
+            frame.sync_globals()
+        ident = threading.get_ident()
+        if self.frames.get(ident) is frame:
+            del self.frames[ident]
+        self.bytecode = frame.bytecode
+        self.counts = frame.counts
+        self.pairs = frame.pairs
+        self.times = frame.times
+
+    def run_steps(self, bytecode, count=1000, globals=None):
+        """ Generator running `bytecode`, yielding after every `count` instructions.
+        All of the run's state is kept in its Frame between steps. Closing the generator
+        stops the run, like an exception would.
+        """
+        if self.jit:
+            # A compiled loop runs to the end as one instruction
+            raise ValueError("compiled loops can't be run in steps")
+        frame = self.start(bytecode, globals)
+        while not self.step(frame, count):
+            try:
+                yield
+            except BaseException:
+                # `step` finishes the frame itself when it ends or raises
+                self.finish(frame)
+                raise
+
+    async def run_async(self, bytecode, count=1000, globals=None):
+        """ Run `bytecode`, giving control back to the event loop every `count` instructions.
+        Cancelling it stops the run.
+        """
+        with contextlib.closing(self.run_steps(bytecode, count, globals)) as steps:
+            for _ in steps:
+                await asyncio.sleep(0)
+
+    def instrumentation_report(self) -> dict:
+        """ Return the instrumentation results of the last run as a JSON-serializable dict.
+        `offsets` lists the instructions that ran, most executed first, and `pairs`
+        the opcodes that ran one after the other, most frequent first.
+        """
+        code = self.bytecode.decode()
+        opcodes = {}
+        offsets = []
+        for pc, runs in enumerate(self.counts):
+            if not runs:
+                continue
+            opcode, oparg = code[pc]
+            opname = OPNAMES[opcode]
+            offsets.append({"pc": pc, "opname": opname, "oparg": oparg, "count": runs})
+            stats = opcodes.setdefault(opname, {"count": 0})
+            stats["count"] += runs
+        if self.times:
+            for opname, stats in opcodes.items():
+                stats["time_ns"] = self.times[OPCODES[opname]]
+        offsets.sort(key=lambda offset: offset["count"], reverse=True)
+        width = len(OPNAMES)
+        pairs = [
+            {"pair": [OPNAMES[x // width], OPNAMES[x % width]], "count": count}
+            for x, count in enumerate(self.pairs)
+            if count and x // width != OPCODES["EXTENDED_ARG"]
+        ]
+        pairs.sort(key=lambda pair: pair["count"], reverse=True)
+        return {
+            "instructions": sum(self.counts),
+            "opcodes": opcodes,
+            "offsets": offsets,
+            "pairs": pairs,
+        }
+
+
+class Profiler:
+    """ Sampling profiler for the code running on a VirtualMachine.
+    A background thread wakes up every `interval` seconds and records the instruction
+    each of the VM's frames is on, so the code runs unchanged and the overhead only
+    depends on the sampling rate. While the code holds the GIL, the thread can't sample
+    more often than `sys.getswitchinterval()`. Samples are only mapped to source lines,
+    with `Code.lines`, when reported.
+    Needs the "loop" engine, since the "closure" engine doesn't keep `Frame.pc` up to
+    date. Time in loops compiled by the jit counts on the line of the loop.
+    """
+
+    def __init__(self, vm, interval=0.001):
+        if vm.engine != "loop":
+            raise ValueError("profiling needs the 'loop' engine")
+        self.vm = vm
+        self.interval = interval
+        # (Code, pc of the next instruction) -> number of samples
+        self.samples = defaultdict(int)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """ Start sampling from a daemon thread, until `stop` """
+        if self.thread is not None:
+            raise RuntimeError("the profiler is already running")
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sample, name="curvy-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop sampling, and wait for the thread to finish """
+        if self.thread is None:
+            raise RuntimeError("the profiler isn't running")
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def sample(self):
+        samples = self.samples
+        frames = self.vm.frames
+        while not self.stopping.wait(self.interval):
+            for frame in list(frames.values()):
+                samples[frame.bytecode, frame.pc] += 1
+
+    def line_counts(self) -> dict:
+        """ Return {(line, opname): samples} of the instructions sampled, most sampled first.
+        Lines of every Code run while profiling are counted together.
+        """
+        counts = defaultdict(int)
+        for (bytecode, pc), samples in self.samples.items():
+            # `pc` already points past the instruction being run. Right after a jump it
+            # is the target, so the sample counts on the instruction before it
+            pc = max(pc - 1, 0)
+            code = bytecode.decode()
+            if pc >= len(code):
+                continue
+            opcode = code[pc][0]
+            counts[bytecode.lines()[pc], OPNAMES[opcode]] += samples
+        return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+    def collapsed(self, root="curvy", opcodes=False) -> str:
+        """ Return the samples as collapsed stacks, the input of flamegraph.pl and
+        speedscope: a `root;line N count` line per source line, and with `opcodes` a
+        `root;line N;OPNAME count` line per opcode run on it
+        """
+        stacks = defaultdict(int)
+        for (line, opname), samples in self.line_counts().items():
+            stack = f"{root};line {line}"
+            if opcodes:
+                stack += f";{opname}"
+            stacks[stack] += samples
+        return "".join(f"{stack} {samples}\n" for stack, samples in stacks.items())
+
+
+class Frame:
+    """ The state of one run of a Code object on a VirtualMachine.
+    Code is never changed by running it, apart from adaptive rewrites of its decoded
+    instructions, so many frames can run the same Code at once on different threads.
+    Handlers are called by the VM's dispatch list with the frame as `self`.
+    """
+
+    __slots__ = (
+        "vm",
+        "bytecode",
+        "code",
+        "globals",
+        "builtins",
+        "stack",
+        "sp",
+        "pc",
+        "fastlocals",
+        "binary_operators",
+        "instructions",
+        "deadline",
+        "counts",
+        "pairs",
+        "times",
+        "op",
+    )
+
+    def __init__(self, vm, bytecode, globals):
+        self.vm = vm
         self.bytecode = bytecode
-        real_oparg = 0
+        self.code = bytecode.decode()
+        self.globals = globals
+        self.builtins = vm.builtins
+        # Preallocated to `Code.stacksize`, `sp` is the index of the first free slot
+        self.stack = [None] * bytecode.stacksize
+        self.sp = 0
         self.pc = 0
-        code = list(zip(bytecode.code[::2], bytecode.code[1::2]))
+        # Values of the code's variables, indexed by name number, when it uses slots.
+        # Loaded from `globals` by `VirtualMachine.start`, and stored back after.
+        self.fastlocals = []
+        # Generic binary opcode -> the operation it performs, for superinstructions
+        if vm.limited:
+            self.binary_operators = dict(BINARY_OPERATORS)
+            self.binary_operators[OPCODES["BINARY_ADD"]] = self.limited_add
+            self.binary_operators[OPCODES["BINARY_MUL"]] = self.limited_mul
+        else:
+            self.binary_operators = BINARY_OPERATORS
+        self.instructions = 0  # Instructions run so far when limited, a loop pass at a time
+        self.deadline = None
+        # Instrumentation, see `VirtualMachine.instrumentation_report`
+        self.counts = []
+        self.pairs = []
+        self.times = []
+        self.op = None  # Closure to run next, for the "closure" engine
+
+    def execute(self):
+        """ Run decoded instructions from `self.pc` until the end of the code """
+        code = self.code
+        end = len(code)
+        dispatch = self.vm.dispatch
+
+        while self.pc < end:
+            opcode, oparg = code[self.pc]
+            self.pc += 1
+            dispatch[opcode](self, oparg)
 
-        while self.pc < len(code):
+    def execute_counted(self):
+        """ `execute`, counting how many times each instruction, and each pair of
+        opcodes run one after the other, runs
+        """
+        code = self.code
+        end = len(code)
+        dispatch = self.vm.dispatch
+        counts = self.counts = [0] * end
+        width = len(OPNAMES)
+        # Indexed by previous opcode * width + opcode
+        pairs = self.pairs = [0] * (width * width)
+        previous = OPCODES["EXTENDED_ARG"]
+
+        while self.pc < end:
+            counts[self.pc] += 1
             opcode, oparg = code[self.pc]
+            pairs[previous * width + opcode] += 1
+            previous = opcode
             self.pc += 1
-            real_oparg = (real_oparg << 8) + oparg
-            if OPNAMES[opcode] == "EXTENDED_ARG":
-                continue
-            handler = getattr(self, f"visit_{OPNAMES[opcode]}")
-            handler(real_oparg)
-            real_oparg = 0
+            dispatch[opcode](self, oparg)
+
+    def execute_timed(self):
+        """ `execute`, counting each instruction and timing each opcode """
+        code = self.code
+        end = len(code)
+        dispatch = self.vm.dispatch
+        counts = self.counts = [0] * end
+        times = self.times = [0] * len(OPNAMES)
+        clock = time.perf_counter_ns
+
+        while self.pc < end:
+            counts[self.pc] += 1
+            opcode, oparg = code[self.pc]
+            self.pc += 1
+            start = clock()
+            dispatch[opcode](self, oparg)
+            times[opcode] += clock() - start
 
-        assert not self.stack, "stack should be empty!"
+    def step(self, count):
+        """ Run at most `count` more instructions. Return True once the code has finished.
+        Instrumentation is not collected while stepping.
+        """
+        code = self.code
+        end = len(code)
+        dispatch = self.vm.dispatch
+        try:
+            for _ in range(count):
+                if self.pc >= end:
+                    break
+                opcode, oparg = code[self.pc]
+                self.pc += 1
+                dispatch[opcode](self, oparg)
+        except BaseException:
+            self.vm.finish(self)
+            raise
+
+        if self.pc < end:
+            return False
+        self.vm.finish(self)
+        assert self.sp == 0, "stack should be empty!"
+        return True
+
+    def execute_closures(self):
+        """ `execute` for the "closure" engine, calling each closure the one before returned """
+        op = self.op
+        while op is not None:
+            op = op(self)
+
+    def step_closures(self, count):
+        """ `step` for the "closure" engine """
+        op = self.op
+        try:
+            for _ in range(count):
+                if op is None:
+                    break
+                op = op(self)
+        except BaseException:
+            self.vm.finish(self)
+            raise
+
+        self.op = op
+        if op is not None:
+            return False
+        self.vm.finish(self)
+        assert self.sp == 0, "stack should be empty!"
+        return True
+
+    def sync_globals(self):
+        """ Store the values of the variable slots into `globals` and return it.
+        `VirtualMachine.finish` does this, so the REPL sees a normal dict
+        """
+        for name, value in zip(self.bytecode.names, self.fastlocals):
+            if value is UNBOUND:
+                self.globals.pop(name, None)
+            else:
+                self.globals[name] = value
+        return self.globals
+
+    def deoptimize(self, generic):
+        """ Called by a specialized instruction whose type guard failed.
+        Rewrites it back to the generic opcode and runs that instead.
+        """
+        self.vm.specialized_misses += 1
+        self.code[self.pc - 1] = (generic, 0)
+        self.vm.dispatch[generic](self, 0)
+
+    def limited_JUMP(self, oparg):
+        if oparg < self.pc:
+            # A backward jump closes a loop, charge for one pass through its body
+            self.instructions += self.pc - oparg
+            vm = self.vm
+            if vm.max_instructions is not None and self.instructions > vm.max_instructions:
+                raise ResourceLimitExceeded("instruction limit exceeded", self.pc - 1)
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                raise ResourceLimitExceeded("time limit exceeded", self.pc - 1)
+        self.pc = oparg
+
+    def jit_JUMP(self, oparg):
+        if oparg < self.pc:
+            loop = self.vm.hot_loop(self, oparg)
+            if loop is not None:
+                vm = self.vm
+                start = time.perf_counter_ns()
+                target = loop(self)
+                vm.loop_time += time.perf_counter_ns() - start
+                vm.loop_runs += 1
+                if target == oparg:
+                    vm.guard_exits += 1
+                elif target < oparg:
+                    # Left through the back edge of an outer loop, which sets `pc` to
+                    # after the jump, see `LoopCompiler.exit`
+                    self.jit_JUMP(target)
+                    return
+                self.pc = target
+                return
+        self.pc = oparg
+
+    def limited_CALL_FUNCTION(self, oparg):
+        # Check arguments before the call, so `list(range(10 ** 9))` never gets built
+        for arg in self.stack[self.sp - oparg:self.sp]:
+            self.check_size(arg)
+        self.visit_CALL_FUNCTION(oparg)
+        self.check_size(self.stack[self.sp - 1])
+
+    def limited_add(self, left, right):
+        result = left + right
+        self.check_size(result)
+        return result
+
+    def limited_mul(self, left, right):
+        # Check repetition before it happens, so `[0] * 10 ** 9` never gets built
+        max_size = self.vm.max_size
+        if max_size is not None:
+            for sequence, times in ((left, right), (right, left)):
+                if (
+                    isinstance(sequence, (str, bytes, list, tuple))
+                    and isinstance(times, int)
+                    and len(sequence) * times > max_size
+                ):
+                    raise ResourceLimitExceeded("container size limit exceeded", self.pc - 1)
+        return left * right
+
+    def check_size(self, value, pc=None):
+        """ Raise if `value` is a container longer than the VM's `max_size`, blaming the
+        current instruction unless `pc` is given
+        """
+        max_size = self.vm.max_size
+        if (
+            max_size is not None
+            and isinstance(value, (str, bytes, list, tuple, set, frozenset, dict, range))
+            and len(value) > max_size
+        ):
+            raise ResourceLimitExceeded(
+                "container size limit exceeded", self.pc - 1 if pc is None else pc
+            )
 
     def visit_LOAD_CONST(self, oparg):
-        self.stack.append(self.bytecode.consts[oparg])
+        self.stack[self.sp] = self.bytecode.consts[oparg]
+        self.sp += 1
 
     def visit_BINARY_ADD(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left + right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] + stack[sp]
 
     def visit_BINARY_SUB(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left - right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] - stack[sp]
 
     def visit_BINARY_MUL(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left * right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] * stack[sp]
 
     def visit_BINARY_DIV(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left / right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] / stack[sp]
 
     def visit_BINARY_MOD(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left % right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] % stack[sp]
 
     def visit_BINARY_POW(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left ** right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] ** stack[sp]
 
     def visit_BINARY_FLOORDIV(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left // right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] // stack[sp]
 
     def visit_BIT_AND(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left & right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] & stack[sp]
 
     def visit_BIT_OR(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left | right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] | stack[sp]
 
     def visit_BIT_XOR(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left ^ right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] ^ stack[sp]
 
     def visit_LSHIFT(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left << right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] << stack[sp]
 
     def visit_RSHIFT(self, oparg):
-        right = self.stack.pop()
-        left = self.stack.pop()
-        self.stack.append(left >> right)
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1] >> stack[sp]
+
+    def visit_BINARY_ADD_INT(self, oparg):
+        stack = self.stack
+        sp = self.sp - 1
+        left = stack[sp - 1]
+        right = stack[sp]
+        if type(left) is int and type(right) is int:
+            stack[sp - 1] = left + right
+            self.sp = sp
+            self.vm.specialized_hits += 1
+        else:
+            self.deoptimize(OPCODES["BINARY_ADD"])
+
+    def visit_BINARY_ADD_FLOAT(self, oparg):
+        stack = self.stack
+        sp = self.sp - 1
+        left = stack[sp - 1]
+        right = stack[sp]
+        if type(left) is float and type(right) is float:
+            stack[sp - 1] = left + right
+            self.sp = sp
+            self.vm.specialized_hits += 1
+        else:
+            self.deoptimize(OPCODES["BINARY_ADD"])
+
+    def visit_BINARY_SUB_INT(self, oparg):
+        stack = self.stack
+        sp = self.sp - 1
+        left = stack[sp - 1]
+        right = stack[sp]
+        if type(left) is int and type(right) is int:
+            stack[sp - 1] = left - right
+            self.sp = sp
+            self.vm.specialized_hits += 1
+        else:
+            self.deoptimize(OPCODES["BINARY_SUB"])
+
+    def visit_BINARY_SUB_FLOAT(self, oparg):
+        stack = self.stack
+        sp = self.sp - 1
+        left = stack[sp - 1]
+        right = stack[sp]
+        if type(left) is float and type(right) is float:
+            stack[sp - 1] = left - right
+            self.sp = sp
+            self.vm.specialized_hits += 1
+        else:
+            self.deoptimize(OPCODES["BINARY_SUB"])
+
+    def visit_BINARY_MUL_INT(self, oparg):
+        stack = self.stack
+        sp = self.sp - 1
+        left = stack[sp - 1]
+        right = stack[sp]
+        if type(left) is int and type(right) is int:
+            stack[sp - 1] = left * right
+            self.sp = sp
+            self.vm.specialized_hits += 1
+        else:
+            self.deoptimize(OPCODES["BINARY_MUL"])
+
+    def visit_BINARY_MUL_FLOAT(self, oparg):
+        stack = self.stack
+        sp = self.sp - 1
+        left = stack[sp - 1]
+        right = stack[sp]
+        if type(left) is float and type(right) is float:
+            stack[sp - 1] = left * right
+            self.sp = sp
+            self.vm.specialized_hits += 1
+        else:
+            self.deoptimize(OPCODES["BINARY_MUL"])
 
     def visit_UNARY_ADD(self, oparg):
-        operand = self.stack.pop()
-        self.stack.append(+operand)
+        stack = self.stack
+        stack[self.sp - 1] = +stack[self.sp - 1]
 
     def visit_UNARY_SUB(self, oparg):
-        operand = self.stack.pop()
-        self.stack.append(-operand)
+        stack = self.stack
+        stack[self.sp - 1] = -stack[self.sp - 1]
 
     def visit_UNARY_NOT(self, oparg):
-        operand = self.stack.pop()
-        self.stack.append(not operand)
+        stack = self.stack
+        stack[self.sp - 1] = not stack[self.sp - 1]
 
     def visit_UNARY_INVERT(self, oparg):
-        operand = self.stack.pop()
-        self.stack.append(~operand)
+        stack = self.stack
+        stack[self.sp - 1] = ~stack[self.sp - 1]
 
     def visit_PRINT_EXPR(self, oparg):
-        output = self.stack.pop()
+        self.sp -= 1
+        output = self.stack[self.sp]
         if output is not None:
             print(repr(output))
 
     def visit_STORE_NAME(self, oparg):
         name = self.bytecode.names[oparg]
-        self.globals[name] = self.stack.pop()
+        self.sp -= 1
+        self.globals[name] = self.stack[self.sp]
 
     def visit_LOAD_NAME(self, oparg):
         name = self.bytecode.names[oparg]
 
         if name in self.globals:
-            self.stack.append(self.globals[name])
+            self.stack[self.sp] = self.globals[name]
         elif name in self.builtins:
-            self.stack.append(self.builtins[name])
+            self.stack[self.sp] = self.builtins[name]
         else:
             raise NameError(f"name {name!r} is not defined")
+        self.sp += 1
 
     def visit_DEL_NAME(self, oparg):
         name = self.bytecode.names[oparg]
         # Deleting in virtual machine
         del self.globals[name]
 
+    def lookup_name(self, oparg):
+        """ Return the value of a name for superinstructions, like LOAD_NAME """
+        name = self.bytecode.names[oparg]
+        if name in self.globals:
+            return self.globals[name]
+        elif name in self.builtins:
+            return self.builtins[name]
+        raise NameError(f"name {name!r} is not defined")
+
+    def lookup_fast(self, oparg):
+        """ Return the value of a variable slot for superinstructions, like LOAD_FAST """
+        value = self.fastlocals[oparg]
+        if value is UNBOUND:
+            name = self.bytecode.names[oparg]
+            if name not in self.builtins:
+                raise NameError(f"name {name!r} is not defined")
+            return self.builtins[name]
+        return value
+
+    def visit_BINARY_OP_NAME_CONST(self, oparg):
+        value = self.lookup_name(oparg >> 24)
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        self.stack[self.sp] = self.binary_operators[oparg & 0xFF](value, const)
+        self.sp += 1
+
+    def visit_INPLACE_OP_NAME_CONST(self, oparg):
+        value = self.lookup_name(oparg >> 24)
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        self.globals[self.bytecode.names[oparg >> 24]] = self.binary_operators[oparg & 0xFF](
+            value, const
+        )
+
+    def visit_LOAD_NAME_NAME(self, oparg):
+        self.stack[self.sp] = self.lookup_name(oparg >> 16)
+        self.stack[self.sp + 1] = self.lookup_name(oparg & 0xFFFF)
+        self.sp += 2
+
+    def visit_BINARY_OP_FAST_CONST(self, oparg):
+        value = self.lookup_fast(oparg >> 24)
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        self.stack[self.sp] = self.binary_operators[oparg & 0xFF](value, const)
+        self.sp += 1
+
+    def visit_INPLACE_OP_FAST_CONST(self, oparg):
+        value = self.lookup_fast(oparg >> 24)
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        self.fastlocals[oparg >> 24] = self.binary_operators[oparg & 0xFF](value, const)
+
+    def visit_LOAD_FAST_FAST(self, oparg):
+        self.stack[self.sp] = self.lookup_fast(oparg >> 16)
+        self.stack[self.sp + 1] = self.lookup_fast(oparg & 0xFFFF)
+        self.sp += 2
+
+    def visit_STORE_FAST(self, oparg):
+        self.sp -= 1
+        self.fastlocals[oparg] = self.stack[self.sp]
+
+    def visit_LOAD_FAST(self, oparg):
+        value = self.fastlocals[oparg]
+        if value is UNBOUND:
+            # Nothing was stored in the slot, so fall back to builtins
+            name = self.bytecode.names[oparg]
+            if name not in self.builtins:
+                raise NameError(f"name {name!r} is not defined")
+            value = self.builtins[name]
+        self.stack[self.sp] = value
+        self.sp += 1
+
+    def visit_DEL_FAST(self, oparg):
+        if self.fastlocals[oparg] is UNBOUND:
+            raise NameError(f"name {self.bytecode.names[oparg]!r} is not defined")
+        self.fastlocals[oparg] = UNBOUND
+
     def visit_DUP_TOP(self, oparg):
-        self.stack.append(self.stack[-1])
+        self.stack[self.sp] = self.stack[self.sp - 1]
+        self.sp += 1
 
     def visit_POP_TOP(self, oparg):
-        self.stack.pop()
+        self.sp -= 1
+
+    def visit_ROT_TWO(self, oparg):
+        stack = self.stack
+        sp = self.sp
+        stack[sp - 2], stack[sp - 1] = stack[sp - 1], stack[sp - 2]
+
+    def visit_ROT_THREE(self, oparg):
+        stack = self.stack
+        sp = self.sp
+        stack[sp - 3], stack[sp - 2], stack[sp - 1] = stack[sp - 1], stack[sp - 3], stack[sp - 2]
 
     def visit_BUILD_TUPLE(self, oparg):
-        tup = []
-        for x in range(oparg):
-            tup.append(self.stack.pop())
-        self.stack.append(tuple(tup[::-1]))
+        sp = self.sp - oparg
+        self.stack[sp] = tuple(self.stack[sp:self.sp])
+        self.sp = sp + 1
 
     def visit_BUILD_LIST(self, oparg):
-        lst = []
-        for x in range(oparg):
-            lst.append(self.stack.pop())
-        self.stack.append(lst[::-1])
+        sp = self.sp - oparg
+        self.stack[sp] = self.stack[sp:self.sp]
+        self.sp = sp + 1
 
     def visit_BUILD_SET(self, oparg):
-        st = set()
-        for x in range(oparg):
-            st.add(self.stack.pop())
-        self.stack.append(st)
+        sp = self.sp - oparg
+        self.stack[sp] = set(self.stack[sp:self.sp])
+        self.sp = sp + 1
 
     def visit_BUILD_DICT(self, oparg):
+        # Each item is pushed as value, then key
+        stack = self.stack
+        sp = self.sp - 2 * oparg
         dct = {}
-        for x in range(oparg):
-            key = self.stack.pop()
-            value = self.stack.pop()
-            dct[key] = value
-        self.stack.append(dct)
+        for x in range(sp, self.sp, 2):
+            dct[stack[x + 1]] = stack[x]
+        stack[sp] = dct
+        self.sp = sp + 1
 
     def visit_INDEX(self, oparg):
-        index = self.stack.pop()
-        value = self.stack.pop()
-        self.stack.append(value[index])
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = stack[sp - 1][stack[sp]]
 
     def visit_JUMP(self, oparg):
         self.pc = oparg
 
     def visit_JUMP_IF_FALSE(self, oparg):
-        if not self.stack[-1]:
+        if not self.stack[self.sp - 1]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_FALSE(self, oparg):
+        self.sp -= 1
+        if not self.stack[self.sp]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_TRUE(self, oparg):
+        self.sp -= 1
+        if self.stack[self.sp]:
+            self.pc = oparg
+
+    def visit_JUMP_IF_FALSE_OR_POP(self, oparg):
+        if self.stack[self.sp - 1]:
+            self.sp -= 1
+        else:
+            self.pc = oparg
+
+    def visit_JUMP_IF_TRUE_OR_POP(self, oparg):
+        if self.stack[self.sp - 1]:
+            self.pc = oparg
+        else:
+            self.sp -= 1
+
+    def visit_COMPARE_OP(self, oparg):
+        stack = self.stack
+        sp = self.sp = self.sp - 1
+        stack[sp - 1] = COMPARE_OPERATORS[oparg](stack[sp - 1], stack[sp])
+
+    def visit_POP_JUMP_IF_NOT_LT(self, oparg):
+        sp = self.sp = self.sp - 2
+        if not self.stack[sp] < self.stack[sp + 1]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_NOT_LE(self, oparg):
+        sp = self.sp = self.sp - 2
+        if not self.stack[sp] <= self.stack[sp + 1]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_NOT_EQ(self, oparg):
+        sp = self.sp = self.sp - 2
+        if not self.stack[sp] == self.stack[sp + 1]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_NOT_NE(self, oparg):
+        sp = self.sp = self.sp - 2
+        if not self.stack[sp] != self.stack[sp + 1]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_NOT_GT(self, oparg):
+        sp = self.sp = self.sp - 2
+        if not self.stack[sp] > self.stack[sp + 1]:
+            self.pc = oparg
+
+    def visit_POP_JUMP_IF_NOT_GE(self, oparg):
+        sp = self.sp = self.sp - 2
+        if not self.stack[sp] >= self.stack[sp + 1]:
             self.pc = oparg
 
     def visit_GET_ITER(self, oparg):
-        # Pops TOS, turns it into an iter, and pushes back to TOS
-        top = self.stack.pop()
-        self.stack.append(iter(top))
+        # Replaces TOS with an iterator over it
+        self.stack[self.sp - 1] = iter(self.stack[self.sp - 1])
 
     def visit_FOR_ITER(self, oparg):
         # Will either call next() on the top of the stack (hopefully its an iterator). If the iterator is exausted, jump to the arg
-        iterator = self.stack[-1]
         try:
-            self.stack.append(next(iterator))
+            self.stack[self.sp] = next(self.stack[self.sp - 1])
         except StopIteration:
             # If the iterator is exausted, jump
             self.pc = oparg
+            return
+        self.sp += 1
+
+    def visit_GET_RANGE_ITER(self, oparg):
+        # Pops range and its oparg args. If range is still the builtin and the args are ints,
+        # pushes the first value and the bound. Otherwise falls back to pushing an iterator over
+        # the call and None, which FOR_RANGE handles like FOR_ITER.
+        stack = self.stack
+        sp = self.sp - oparg - 1
+        func = stack[sp]
+        args = stack[sp + 1:self.sp]
+        if func is range and all(type(arg) is int for arg in args):
+            if oparg == 1:
+                stack[sp], stack[sp + 1] = 0, args[0]
+            else:
+                stack[sp], stack[sp + 1] = args
+        else:
+            stack[sp], stack[sp + 1] = iter(func(*args)), None
+        self.sp = sp + 2
+
+    def visit_FOR_RANGE(self, oparg):
+        stack = self.stack
+        sp = self.sp
+        stop = stack[sp - 1]
+        if stop is None:
+            try:
+                value = next(stack[sp - 2])
+            except StopIteration:
+                self.pc = oparg
+                return
+        else:
+            value = stack[sp - 2]
+            if value >= stop:
+                self.pc = oparg
+                return
+            stack[sp - 2] = value + 1
+        stack[sp] = value
+        self.sp = sp + 1
 
     def visit_CALL_FUNCTION(self, oparg):
         # Function calls. Oparg is the number of arguments on the stack, function is under all the args
+        stack = self.stack
+        sp = self.sp - oparg
+        # Running function and replacing it on the stack with its return value.
+        # Only the arguments are copied, never the rest of the stack
+        stack[sp - 1] = stack[sp - 1](*stack[sp:self.sp])
+        self.sp = sp
+
+
+class ClosureTranslator:
+    """ Translates a Code object into one Python closure per instruction, for
+    `VirtualMachine(engine="closure")`. Each closure takes the running Frame, runs its
+    instruction with the operands (const values, names, jump targets) already bound, and
+    returns the closure to run next, or None at the end of the code. Returning its
+    successor rather than calling it keeps loops from growing the Python stack.
+    Opcodes without a `translate_*` method run their handler from the VM's dispatch list.
+    """
+
+    # Opcodes whose handlers check limits, see `VirtualMachine.build_dispatch`, along with
+    # the superinstructions doing limited arithmetic through `Frame.binary_operators`
+    LIMITED = CONDITIONAL_JUMPS | {
+        OPCODES[opname]
+        for opname in (
+            "JUMP",
+            "CALL_FUNCTION",
+            "BUILD_LIST",
+            "BUILD_TUPLE",
+            "BUILD_SET",
+            "BUILD_DICT",
+            "BINARY_ADD",
+            "BINARY_MUL",
+            "BINARY_OP_NAME_CONST",
+            "INPLACE_OP_NAME_CONST",
+            "BINARY_OP_FAST_CONST",
+            "INPLACE_OP_FAST_CONST",
+        )
+    }
+
+    def __init__(self, vm, bytecode):
+        self.vm = vm
+        self.bytecode = bytecode
+        # Closure of each instruction, followed by None for the end of the code
+        self.ops = [None] * (len(bytecode.decode()) + 1)
+
+    def translate(self):
+        """ Return the list of closures, indexed by pc """
+        code = self.bytecode.decode()
+        ops = self.ops
+        # Built last to first, so each closure can bind the one after it
+        for pc in range(len(code) - 1, -1, -1):
+            opcode, oparg = code[pc]
+            translator = getattr(self, f"translate_{OPNAMES[opcode]}", None)
+            if self.vm.limited and opcode in self.LIMITED:
+                ops[pc] = self.translate_handler(opcode, oparg, pc)
+            elif opcode in BINARY_OPERATORS:
+                ops[pc] = self.translate_binary(BINARY_OPERATORS[opcode], ops[pc + 1])
+            elif opcode in COMPARE_JUMPS:
+                operation = COMPARE_OPERATORS[COMPARE_JUMPS[opcode]]
+                ops[pc] = self.translate_compare_jump(operation, oparg, ops[pc + 1])
+            elif translator is not None:
+                ops[pc] = translator(oparg, ops[pc + 1])
+            else:
+                ops[pc] = self.translate_handler(opcode, oparg, pc)
+        return ops
+
+    def translate_handler(self, opcode, oparg, pc):
+        """ Return a closure running the opcode's `Frame` handler, which may jump """
+        handler = self.vm.dispatch[opcode]
+        ops = self.ops
+
+        def op(frame):
+            frame.pc = pc + 1
+            handler(frame, oparg)
+            return ops[frame.pc]
+
+        return op
+
+    def translate_binary(self, operation, next_op):
+        """ Return a closure for any binary opcode, running `operation` on the top two values """
+
+        def op(frame):
+            stack = frame.stack
+            sp = frame.sp = frame.sp - 1
+            stack[sp - 1] = operation(stack[sp - 1], stack[sp])
+            return next_op
+
+        return op
+
+    def translate_compare_jump(self, operation, oparg, next_op):
+        """ Return a closure for any POP_JUMP_IF_NOT_* opcode, comparing with `operation` """
+        ops = self.ops
+
+        def op(frame):
+            stack = frame.stack
+            sp = frame.sp = frame.sp - 2
+            if operation(stack[sp], stack[sp + 1]):
+                return next_op
+            return ops[oparg]
+
+        return op
+
+    def translate_COMPARE_OP(self, oparg, next_op):
+        return self.translate_binary(COMPARE_OPERATORS[oparg], next_op)
+
+    def translate_LOAD_CONST(self, oparg, next_op):
+        value = self.bytecode.consts[oparg]
+
+        def op(frame):
+            frame.stack[frame.sp] = value
+            frame.sp += 1
+            return next_op
+
+        return op
+
+    def translate_LOAD_NAME(self, oparg, next_op):
+        name = self.bytecode.names[oparg]
+
+        def op(frame):
+            try:
+                value = frame.globals[name]
+            except KeyError:
+                value = frame.lookup_name(oparg)
+            frame.stack[frame.sp] = value
+            frame.sp += 1
+            return next_op
+
+        return op
+
+    def translate_STORE_NAME(self, oparg, next_op):
+        name = self.bytecode.names[oparg]
+
+        def op(frame):
+            frame.sp -= 1
+            frame.globals[name] = frame.stack[frame.sp]
+            return next_op
+
+        return op
+
+    def translate_LOAD_FAST(self, oparg, next_op):
+        def op(frame):
+            value = frame.fastlocals[oparg]
+            if value is UNBOUND:
+                value = frame.lookup_fast(oparg)
+            frame.stack[frame.sp] = value
+            frame.sp += 1
+            return next_op
+
+        return op
+
+    def translate_STORE_FAST(self, oparg, next_op):
+        def op(frame):
+            frame.sp -= 1
+            frame.fastlocals[oparg] = frame.stack[frame.sp]
+            return next_op
+
+        return op
+
+    def translate_DUP_TOP(self, oparg, next_op):
+        def op(frame):
+            frame.stack[frame.sp] = frame.stack[frame.sp - 1]
+            frame.sp += 1
+            return next_op
+
+        return op
+
+    def translate_POP_TOP(self, oparg, next_op):
+        def op(frame):
+            frame.sp -= 1
+            return next_op
+
+        return op
+
+    def translate_JUMP(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            return ops[oparg]
+
+        return op
+
+    def translate_JUMP_IF_FALSE(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            if frame.stack[frame.sp - 1]:
+                return next_op
+            return ops[oparg]
+
+        return op
+
+    def translate_POP_JUMP_IF_FALSE(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            frame.sp -= 1
+            if frame.stack[frame.sp]:
+                return next_op
+            return ops[oparg]
+
+        return op
+
+    def translate_POP_JUMP_IF_TRUE(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            frame.sp -= 1
+            if frame.stack[frame.sp]:
+                return ops[oparg]
+            return next_op
+
+        return op
+
+    def translate_JUMP_IF_FALSE_OR_POP(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            if frame.stack[frame.sp - 1]:
+                frame.sp -= 1
+                return next_op
+            return ops[oparg]
+
+        return op
+
+    def translate_JUMP_IF_TRUE_OR_POP(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            if frame.stack[frame.sp - 1]:
+                return ops[oparg]
+            frame.sp -= 1
+            return next_op
+
+        return op
+
+    def translate_ROT_TWO(self, oparg, next_op):
+        def op(frame):
+            stack = frame.stack
+            sp = frame.sp
+            stack[sp - 2], stack[sp - 1] = stack[sp - 1], stack[sp - 2]
+            return next_op
+
+        return op
+
+    def translate_FOR_ITER(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            stack = frame.stack
+            sp = frame.sp
+            try:
+                stack[sp] = next(stack[sp - 1])
+            except StopIteration:
+                return ops[oparg]
+            frame.sp = sp + 1
+            return next_op
+
+        return op
+
+    def translate_FOR_RANGE(self, oparg, next_op):
+        ops = self.ops
+
+        def op(frame):
+            stack = frame.stack
+            sp = frame.sp
+            stop = stack[sp - 1]
+            if stop is None:
+                try:
+                    value = next(stack[sp - 2])
+                except StopIteration:
+                    return ops[oparg]
+            else:
+                value = stack[sp - 2]
+                if value >= stop:
+                    return ops[oparg]
+                stack[sp - 2] = value + 1
+            stack[sp] = value
+            frame.sp = sp + 1
+            return next_op
+
+        return op
+
+    def translate_CALL_FUNCTION(self, oparg, next_op):
+        def op(frame):
+            stack = frame.stack
+            sp = frame.sp - oparg
+            stack[sp - 1] = stack[sp - 1](*stack[sp:frame.sp])
+            frame.sp = sp
+            return next_op
+
+        return op
+
+    def translate_BINARY_OP_NAME_CONST(self, oparg, next_op):
+        index = oparg >> 24
+        name = self.bytecode.names[index]
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        operation = BINARY_OPERATORS[oparg & 0xFF]
+
+        def op(frame):
+            try:
+                value = frame.globals[name]
+            except KeyError:
+                value = frame.lookup_name(index)
+            frame.stack[frame.sp] = operation(value, const)
+            frame.sp += 1
+            return next_op
+
+        return op
+
+    def translate_INPLACE_OP_NAME_CONST(self, oparg, next_op):
+        index = oparg >> 24
+        name = self.bytecode.names[index]
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        operation = BINARY_OPERATORS[oparg & 0xFF]
+
+        def op(frame):
+            try:
+                value = frame.globals[name]
+            except KeyError:
+                value = frame.lookup_name(index)
+            frame.globals[name] = operation(value, const)
+            return next_op
+
+        return op
+
+    def translate_LOAD_NAME_NAME(self, oparg, next_op):
+        first = self.translate_LOAD_NAME(oparg >> 16, None)
+        second = self.translate_LOAD_NAME(oparg & 0xFFFF, next_op)
+
+        def op(frame):
+            first(frame)
+            return second(frame)
+
+        return op
+
+    def translate_BINARY_OP_FAST_CONST(self, oparg, next_op):
+        index = oparg >> 24
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        operation = BINARY_OPERATORS[oparg & 0xFF]
+
+        def op(frame):
+            value = frame.fastlocals[index]
+            if value is UNBOUND:
+                value = frame.lookup_fast(index)
+            frame.stack[frame.sp] = operation(value, const)
+            frame.sp += 1
+            return next_op
+
+        return op
+
+    def translate_INPLACE_OP_FAST_CONST(self, oparg, next_op):
+        index = oparg >> 24
+        const = self.bytecode.consts[oparg >> 8 & 0xFFFF]
+        operation = BINARY_OPERATORS[oparg & 0xFF]
+
+        def op(frame):
+            value = frame.fastlocals[index]
+            if value is UNBOUND:
+                value = frame.lookup_fast(index)
+            frame.fastlocals[index] = operation(value, const)
+            return next_op
+
+        return op
+
+    def translate_LOAD_FAST_FAST(self, oparg, next_op):
+        first = self.translate_LOAD_FAST(oparg >> 16, None)
+        second = self.translate_LOAD_FAST(oparg & 0xFFFF, next_op)
+
+        def op(frame):
+            first(frame)
+            return second(frame)
+
+        return op
+
+
+class LoopCompiler:
+    """ Translates one loop of a Code object into a Python function, for
+    `VirtualMachine(jit=True)`. The loop runs from its header, the target of a backward
+    jump, to its last jump back to it. The function takes the running Frame, runs the loop
+    against its globals and variable slots, and returns the pc the interpreter should
+    continue at: where the loop exited, or the header when a guard failed.
+
+    Values on the curvy stack become expressions, only stored in local variables `s0`,
+    `s1`, ... (one per stack position) between basic blocks and before anything with
+    side effects, so `a = a - 1` compiles to `g['a'] = g['a'] - c0`. Blocks are
+    emitted in order as `if pc == ...:` statements inside a `while True:` loop.
+    """
+
+    # Python operator of each binary opcode, and of its type-specialized forms
+    BINARY = {
+        "BINARY_ADD": "+",
+        "BINARY_SUB": "-",
+        "BINARY_DIV": "/",
+        "BINARY_MUL": "*",
+        "BINARY_MOD": "%",
+        "BINARY_POW": "**",
+        "BINARY_FLOORDIV": "//",
+        "BIT_AND": "&",
+        "BIT_OR": "|",
+        "BIT_XOR": "^",
+        "LSHIFT": "<<",
+        "RSHIFT": ">>",
+        "BINARY_ADD_INT": "+",
+        "BINARY_ADD_FLOAT": "+",
+        "BINARY_SUB_INT": "-",
+        "BINARY_SUB_FLOAT": "-",
+        "BINARY_MUL_INT": "*",
+        "BINARY_MUL_FLOAT": "*",
+    }
+    UNARY = {"UNARY_ADD": "+", "UNARY_SUB": "-", "UNARY_NOT": "not ", "UNARY_INVERT": "~"}
+
+    def __init__(self, bytecode, header, jump, depth):
+        self.bytecode = bytecode
+        self.code = bytecode.decode()
+        self.header = header  # pc of the first instruction of the loop
+        self.jump = jump  # pc of the last instruction of the loop
+        self.pc = header  # Instruction being translated
+        # The back edge that got hot may be an inner loop's exit, threaded to the header
+        # by the peephole optimizer. Loops are contiguous, so the loop ends at its last
+        # jump back into it.
+        for pc in range(jump + 1, len(self.code)):
+            opcode, oparg = self.code[pc]
+            if opcode in HASJUMP and header <= oparg <= self.jump:
+                self.jump = pc
+        self.depth = depth  # Stack depth at the header
+        self.lines = []
+        self.indent = 0
+        self.stack = []  # Expression of each value on the stack
+        self.namespace = {"UNBOUND": UNBOUND}  # Globals of the generated function
+        self.builtin_names = set()  # Names bound to a builtin when compiled
+        self.builtin_slots = set()  # The same, for variable slots
+        self.depths = {}  # pc -> stack depth, for each reachable instruction and exit
+        self.starts = set()  # pcs of instructions starting a block
+
+    def compile(self, frame):
+        """ Return the loop's function, or None if the loop can't be compiled.
+        `frame` is only used to tell variables from builtins.
+        """
+        opnames = [OPNAMES[opcode] for opcode, oparg in self.code[self.header:self.jump + 1]]
+        if any(not hasattr(self, f"visit_{opname}") for opname in opnames):
+            return None
+        self.find_blocks()
+        guards = self.find_variables(frame)
+        if guards is None:
+            return None
+
+        self.emit("def loop(frame):")
+        self.indent = 1
+        self.emit("g = frame.globals")
+        self.emit("f = frame.fastlocals")
+        self.emit("stack = frame.stack")
+        # Nothing has run yet when an entry guard fails
+        for name in sorted(guards[0]):
+            self.emit(f"if {name!r} not in g:")
+            self.emit(f"    return {self.header}")
+        for slot in sorted(guards[1]):
+            self.emit(f"if f[{slot}] is UNBOUND:")
+            self.emit(f"    return {self.header}")
+        for x in range(self.depth):
+            self.emit(f"s{x} = stack[{x}]")
+        self.emit(f"pc = {self.header}")
+        self.emit("while True:")
+        self.falls_through = False
+        for pc in range(self.header, self.jump + 1):
+            if pc not in self.depths:
+                continue  # Unreachable
+            if pc in self.starts:
+                if self.falls_through:
+                    self.spill()
+                    self.emit(f"pc = {pc}")
+                self.indent = 2
+                self.emit(f"if pc == {pc}:")
+                self.indent = 3
+                self.stack = [f"s{x}" for x in range(self.depths[pc])]
+                if pc == self.header:
+                    # A variable now shadows a builtin the loop was compiled with
+                    for name in sorted(self.builtin_names):
+                        self.emit(f"if {name!r} in g:")
+                        self.exit(self.header, indent=1)
+            opcode, oparg = self.code[pc]
+            self.pc = pc
+            self.falls_through = True
+            getattr(self, f"visit_{OPNAMES[opcode]}")(oparg, pc)
+
+        source = "\n".join(self.lines) + "\n"
+        exec(compile(source, f"<curvy loop at {self.header}>", "exec"), self.namespace)
+        loop = self.namespace["loop"]
+        loop.source = source
+        return loop
+
+    def find_blocks(self):
+        """ Find the stack depth at every reachable instruction of the loop and at every
+        exit from it, and the instructions that start a block
+        """
+        jump = OPCODES["JUMP"]
+        self.starts = {self.header}
+        todo = [(self.header, self.depth)]
+        while todo:
+            pc, depth = todo.pop()
+            while pc not in self.depths:
+                self.depths[pc] = depth
+                if not self.header <= pc <= self.jump:
+                    break  # An exit
+                opcode, oparg = self.code[pc]
+                if opcode in HASJUMP:
+                    todo.append((oparg, depth + stack_effect(opcode, oparg, jump=True)))
+                    self.starts.add(oparg)
+                    if opcode == jump:
+                        break
+                    # Conditional jumps inside the loop end their block, see `branch`
+                    if opcode in CONDITIONAL_JUMPS and self.header <= oparg <= self.jump:
+                        self.starts.add(pc + 1)
+                depth += stack_effect(opcode, oparg)
+                pc += 1
+
+    def find_variables(self, frame):
+        """ Return the names that must be in the globals, and slots that must be bound,
+        when the loop is entered. Names not in the globals and never stored by the loop
+        are bound to their builtin instead. Return None if the loop would raise NameError.
+        """
+        names = self.bytecode.names
+        loaded, stored, loaded_slots, stored_slots = set(), set(), set(), set()
+        for opcode, oparg in self.code[self.header:self.jump + 1]:
+            opname = OPNAMES[opcode]
+            if opname == "LOAD_NAME":
+                loaded.add(oparg)
+            elif opname in ("BINARY_OP_NAME_CONST", "INPLACE_OP_NAME_CONST"):
+                loaded.add(oparg >> 24)
+            elif opname == "LOAD_NAME_NAME":
+                loaded.update((oparg >> 16, oparg & 0xFFFF))
+            elif opname == "LOAD_FAST":
+                loaded_slots.add(oparg)
+            elif opname in ("BINARY_OP_FAST_CONST", "INPLACE_OP_FAST_CONST"):
+                loaded_slots.add(oparg >> 24)
+            elif opname == "LOAD_FAST_FAST":
+                loaded_slots.update((oparg >> 16, oparg & 0xFFFF))
+            if opname in ("STORE_NAME", "INPLACE_OP_NAME_CONST"):
+                stored.add(oparg if opname == "STORE_NAME" else oparg >> 24)
+            elif opname in ("STORE_FAST", "INPLACE_OP_FAST_CONST"):
+                stored_slots.add(oparg if opname == "STORE_FAST" else oparg >> 24)
+
+        required, required_slots = set(), set()
+        for index in loaded:
+            name = names[index]
+            if name in frame.globals or index in stored:
+                required.add(name)
+            elif name in frame.builtins:
+                self.builtin_names.add(name)
+                self.namespace[f"b_{name}"] = frame.builtins[name]
+            else:
+                return None
+        for slot in loaded_slots:
+            if frame.fastlocals[slot] is not UNBOUND or slot in stored_slots:
+                required_slots.add(slot)
+            elif names[slot] in frame.builtins:
+                self.builtin_slots.add(slot)
+                self.namespace[f"b_{names[slot]}"] = frame.builtins[names[slot]]
+            else:
+                return None
+        return required, required_slots
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def exit(self, pc, indent=0):
+        """ Emit a return to the interpreter at `pc`, with the stack as it is there """
+        depth = self.depths[pc]
+        for x in range(depth):
+            self.emit("    " * indent + f"stack[{x}] = s{x}")
+        self.emit("    " * indent + f"frame.sp = {depth}")
+        if pc < self.header:
+            # A backward jump, that `Frame.jit_JUMP` counts as coming from here
+            self.emit("    " * indent + f"frame.pc = {self.pc + 1}")
+        self.emit("    " * indent + f"return {pc}")
+
+    def goto(self, pc, indent=0):
+        """ Emit a jump to `pc` out of the middle of a block, inside the loop or out of it """
+        if self.header <= pc <= self.jump:
+            self.emit("    " * indent + f"pc = {pc}")
+            self.emit("    " * indent + "continue")
+        else:
+            self.exit(pc, indent)
+
+    def branch(self, test, target, pc):
+        """ Emit the end of a block jumping to `target` if `test` is true """
+        if self.header <= target <= self.jump:
+            # Blocks are checked in order, so setting pc is enough
+            self.emit(f"pc = {target} if {test} else {pc + 1}")
+            self.falls_through = False
+        else:
+            self.emit(f"if {test}:")
+            self.exit(target, indent=1)
+
+    def const(self, oparg):
+        self.namespace[f"c{oparg}"] = self.bytecode.consts[oparg]
+        return f"c{oparg}"
+
+    def name(self, oparg):
+        name = self.bytecode.names[oparg]
+        if name in self.builtin_names:
+            return f"b_{name}"
+        return f"g[{name!r}]"
+
+    def slot(self, oparg):
+        if oparg in self.builtin_slots:
+            return f"b_{self.bytecode.names[oparg]}"
+        return f"f[{oparg}]"
+
+    def spill(self, keep=0):
+        """ Store every stack value but the top `keep` in its stack variable, so
+        nothing is evaluated out of order with a side effect about to be emitted
+        """
+        for x in range(len(self.stack) - keep):
+            if self.stack[x] != f"s{x}":
+                self.emit(f"s{x} = {self.stack[x]}")
+                self.stack[x] = f"s{x}"
+
+    def push_result(self, expression):
+        """ Push the value of an expression with side effects, evaluating it now """
+        x = len(self.stack)
+        self.emit(f"s{x} = {expression}")
+        self.stack.append(f"s{x}")
 
-        # Getting args from stack
-        args = self.stack[-oparg:]
-        self.stack = self.stack[:-oparg]
+    def visit_LOAD_CONST(self, oparg, pc):
+        self.stack.append(self.const(oparg))
 
-        # Get func from stack
+    def visit_LOAD_NAME(self, oparg, pc):
+        self.stack.append(self.name(oparg))
+
+    def visit_STORE_NAME(self, oparg, pc):
+        self.spill(keep=1)
+        self.emit(f"{self.name(oparg)} = {self.stack.pop()}")
+
+    def visit_LOAD_FAST(self, oparg, pc):
+        self.stack.append(self.slot(oparg))
+
+    def visit_STORE_FAST(self, oparg, pc):
+        self.spill(keep=1)
+        self.emit(f"f[{oparg}] = {self.stack.pop()}")
+
+    def visit_DUP_TOP(self, oparg, pc):
+        self.spill()
+        self.stack.append(self.stack[-1])
+
+    def visit_POP_TOP(self, oparg, pc):
+        value = self.stack.pop()
+        if value != f"s{len(self.stack)}":
+            # Still evaluated, it could raise
+            self.emit(value)
+
+    def visit_binary(self, oparg, pc):
+        right = self.stack.pop()
+        left = self.stack.pop()
+        self.stack.append(f"({left} {self.BINARY[OPNAMES[self.code[pc][0]]]} {right})")
+
+    def visit_unary(self, oparg, pc):
+        operand = self.stack.pop()
+        self.stack.append(f"({self.UNARY[OPNAMES[self.code[pc][0]]]}{operand})")
+
+    def visit_INDEX(self, oparg, pc):
+        index = self.stack.pop()
+        value = self.stack.pop()
+        self.stack.append(f"{value}[{index}]")
+
+    def visit_BUILD_TUPLE(self, oparg, pc):
+        items = self.pop_items(oparg)
+        self.stack.append(f"({''.join(item + ', ' for item in items)})")
+
+    def visit_BUILD_LIST(self, oparg, pc):
+        self.stack.append(f"[{', '.join(self.pop_items(oparg))}]")
+
+    def visit_BUILD_SET(self, oparg, pc):
+        items = self.pop_items(oparg)
+        self.stack.append(f"{{{', '.join(items)}}}" if items else "set()")
+
+    def visit_BUILD_DICT(self, oparg, pc):
+        # Evaluated as pushed, values before their keys
+        self.spill()
+        items = self.pop_items(2 * oparg)
+        pairs = [f"{items[x + 1]}: {items[x]}" for x in range(0, len(items), 2)]
+        self.stack.append(f"{{{', '.join(pairs)}}}")
+
+    def pop_items(self, count):
+        items = self.stack[len(self.stack) - count:]
+        del self.stack[len(self.stack) - count:]
+        return items
+
+    def visit_CALL_FUNCTION(self, oparg, pc):
+        self.spill()
+        args = self.pop_items(oparg)
         func = self.stack.pop()
-        # Running function and appending return to stack
-        self.stack.append(func(*args))
+        self.push_result(f"{func}({', '.join(args)})")
+
+    def visit_PRINT_EXPR(self, oparg, pc):
+        self.spill(keep=1)
+        self.emit(f"value = {self.stack.pop()}")
+        self.emit("if value is not None:")
+        self.emit("    print(repr(value))")
+
+    def visit_GET_ITER(self, oparg, pc):
+        self.spill(keep=1)
+        self.push_result(f"iter({self.stack.pop()})")
+
+    def visit_GET_RANGE_ITER(self, oparg, pc):
+        self.spill()
+        args = self.pop_items(oparg)
+        func = self.stack.pop()
+        x = len(self.stack)
+        ints = " and ".join(f"type({arg}) is int" for arg in args)
+        self.emit(f"if {func} is range and {ints}:")
+        if oparg == 1:
+            self.emit(f"    s{x}, s{x + 1} = 0, {args[0]}")
+        else:
+            self.emit(f"    s{x}, s{x + 1} = {args[0]}, {args[1]}")
+        self.emit("else:")
+        self.emit(f"    s{x}, s{x + 1} = iter({func}({', '.join(args)})), None")
+        self.stack += [f"s{x}", f"s{x + 1}"]
+
+    def visit_JUMP(self, oparg, pc):
+        self.spill()
+        if self.header <= oparg <= self.jump:
+            self.emit(f"pc = {oparg}")
+        else:
+            self.exit(oparg)
+        self.falls_through = False
+
+    def visit_POP_JUMP_IF_FALSE(self, oparg, pc):
+        self.spill(keep=1)
+        self.branch(f"not {self.stack.pop()}", oparg, pc)
+
+    def visit_JUMP_IF_FALSE(self, oparg, pc):
+        self.spill()
+        self.branch(f"not {self.stack[-1]}", oparg, pc)
+
+    def visit_POP_JUMP_IF_TRUE(self, oparg, pc):
+        self.spill(keep=1)
+        self.branch(self.stack.pop(), oparg, pc)
+
+    def visit_JUMP_IF_FALSE_OR_POP(self, oparg, pc):
+        self.spill()
+        self.branch(f"not {self.stack[-1]}", oparg, pc)
+        self.stack.pop()
+
+    def visit_JUMP_IF_TRUE_OR_POP(self, oparg, pc):
+        self.spill()
+        self.branch(self.stack[-1], oparg, pc)
+        self.stack.pop()
+
+    def visit_compare_jump(self, oparg, pc):
+        self.spill(keep=2)
+        right = self.stack.pop()
+        left = self.stack.pop()
+        comparison = COMPARE_NAMES[COMPARE_JUMPS[self.code[pc][0]]]
+        self.branch(f"not ({left} {comparison} {right})", oparg, pc)
+
+    def visit_COMPARE_OP(self, oparg, pc):
+        right = self.stack.pop()
+        left = self.stack.pop()
+        self.stack.append(f"({left} {COMPARE_NAMES[oparg]} {right})")
+
+    def visit_ROT_TWO(self, oparg, pc):
+        # Evaluated in their original order first
+        self.spill()
+        x = len(self.stack)
+        self.emit(f"s{x - 2}, s{x - 1} = s{x - 1}, s{x - 2}")
+
+    def visit_ROT_THREE(self, oparg, pc):
+        self.spill()
+        x = len(self.stack)
+        self.emit(f"s{x - 3}, s{x - 2}, s{x - 1} = s{x - 1}, s{x - 3}, s{x - 2}")
+
+    def visit_FOR_ITER(self, oparg, pc):
+        self.spill()
+        x = len(self.stack)
+        self.emit("try:")
+        self.emit(f"    s{x} = next(s{x - 1})")
+        self.emit("except StopIteration:")
+        self.goto(oparg, indent=1)
+        self.stack.append(f"s{x}")
+
+    def visit_FOR_RANGE(self, oparg, pc):
+        self.spill()
+        x = len(self.stack)
+        self.emit(f"if s{x - 1} is None:")
+        self.emit("    try:")
+        self.emit(f"        s{x} = next(s{x - 2})")
+        self.emit("    except StopIteration:")
+        self.goto(oparg, indent=2)
+        self.emit("else:")
+        self.emit(f"    s{x} = s{x - 2}")
+        self.emit(f"    if s{x} >= s{x - 1}:")
+        self.goto(oparg, indent=2)
+        self.emit(f"    s{x - 2} = s{x} + 1")
+        self.stack.append(f"s{x}")
+
+    def visit_BINARY_OP_NAME_CONST(self, oparg, pc):
+        operator = self.BINARY[OPNAMES[oparg & 0xFF]]
+        name = self.name(oparg >> 24)
+        self.stack.append(f"({name} {operator} {self.const(oparg >> 8 & 0xFFFF)})")
+
+    def visit_INPLACE_OP_NAME_CONST(self, oparg, pc):
+        self.spill()
+        operator = self.BINARY[OPNAMES[oparg & 0xFF]]
+        name = self.name(oparg >> 24)
+        self.emit(f"{name} = {name} {operator} {self.const(oparg >> 8 & 0xFFFF)}")
+
+    def visit_LOAD_NAME_NAME(self, oparg, pc):
+        self.stack += [self.name(oparg >> 16), self.name(oparg & 0xFFFF)]
+
+    def visit_BINARY_OP_FAST_CONST(self, oparg, pc):
+        operator = self.BINARY[OPNAMES[oparg & 0xFF]]
+        slot = self.slot(oparg >> 24)
+        self.stack.append(f"({slot} {operator} {self.const(oparg >> 8 & 0xFFFF)})")
+
+    def visit_INPLACE_OP_FAST_CONST(self, oparg, pc):
+        self.spill()
+        operator = self.BINARY[OPNAMES[oparg & 0xFF]]
+        slot = oparg >> 24
+        self.emit(f"f[{slot}] = {self.slot(slot)} {operator} {self.const(oparg >> 8 & 0xFFFF)}")
+
+    def visit_LOAD_FAST_FAST(self, oparg, pc):
+        self.stack += [self.slot(oparg >> 16), self.slot(oparg & 0xFFFF)]
+
+
+for opname in LoopCompiler.BINARY:
+    setattr(LoopCompiler, f"visit_{opname}", LoopCompiler.visit_binary)
+for opname in LoopCompiler.UNARY:
+    setattr(LoopCompiler, f"visit_{opname}", LoopCompiler.visit_unary)
+for opcode in COMPARE_JUMPS:
+    setattr(LoopCompiler, f"visit_{OPNAMES[opcode]}", LoopCompiler.visit_compare_jump)
+
 
 if __name__ == "__main__":  # pragma: no cover
     vm = VirtualMachine()
+    if len(sys.argv) == 3 and sys.argv[1] == "-c":
+        # Compile a source file to a .curvyc file next to it
+        with open(sys.argv[2], "r") as file:
+            bytecode = compile_source(file.read())
+        save_code(bytecode, sys.argv[2].rsplit(".", 1)[0] + CURVYC_SUFFIX)
+        sys.exit()
+    elif len(sys.argv) > 2 and sys.argv[1] == "--batch":
+        # Run many files in parallel, printing each one's output in order
+        scripts = []
+        for path in sys.argv[2:]:
+            if path.endswith(CURVYC_SUFFIX):
+                scripts.append(load_code(path))
+            else:
+                with open(path, "r") as file:
+                    scripts.append(file.read())
+        for path, result in zip(sys.argv[2:], run_batch(scripts)):
+            sys.stdout.write(result.output)
+            if result.error is not None:
+                print(f"{path}: {result.error!r}", file=sys.stderr)
+        sys.exit()
+    elif len(sys.argv) == 3 and sys.argv[1] == "--profile":
+        # Run a file, then print where it spent its time as collapsed stacks
+        with Profiler(vm) as profiler:
+            run_file(vm, sys.argv[2])
+        sys.stderr.write(profiler.collapsed(os.path.basename(sys.argv[2])))
+        sys.exit()
+    elif len(sys.argv) == 2:
+        run_file(vm, sys.argv[1])
+        sys.exit()
+    elif len(sys.argv) > 1:
+        sys.exit(
+            "usage: curvy [-c file | file | file.curvyc | --batch file ... | --profile file]"
+        )
+
     while True:
         user_input = [input("~~: ")]
         while i := input("... "):
@@ -1,4 +1,11 @@
-from curvy import main, VirtualMachine
+from curvy import main, VirtualMachine, Compiler, CompileCache, Optimizer, OPCODES
+from curvy import compile_source, save_code, load_code, run_file, run_batch, OPNAMES
+from curvy import run_interleaved, run_threaded, ResourceLimitExceeded, Snapshot
+import asyncio
+import ast
+import curvy
+import functools
+import json
 import pytest
 
 
@@ -9,6 +16,19 @@ def assert_out_err(capsys, out, err):
 
 
 vm = VirtualMachine()
+engine_vms = {"loop": vm, "closure": VirtualMachine(engine="closure")}
+
+
+@pytest.fixture(autouse=True, params=["loop", "closure"])
+def engine(request, monkeypatch):
+    """ Run every test on both engines, through `vm` and every VM the test creates """
+    monkeypatch.setitem(globals(), "vm", engine_vms[request.param])
+    monkeypatch.setitem(
+        globals(),
+        "VirtualMachine",
+        functools.partial(curvy.VirtualMachine, engine=request.param),
+    )
+    return request.param
 
 
 def test_ops(capsys):
@@ -89,6 +109,55 @@ def test_logical_op(capsys):
     assert_out_err(capsys, "1\n", "")
 
 
+def test_compare(capsys):
+    main(vm, "a = 3; a < 4; a <= 2; a == 3; a != 3; a > 3; a >= 3")
+    assert_out_err(capsys, "True\nFalse\nTrue\nFalse\nFalse\nTrue\n", "")
+    main(vm, "a = [1]; b = None; 1 in a; 2 not in a; b is None; a is not b; 1 < 2 < 3")
+    assert_out_err(capsys, "True\nTrue\nTrue\nTrue\nTrue\n", "")
+
+    # Chains evaluate each operand once, and stop at the first false comparison
+    main(vm, "a = 5\nb = [0]\n1 < a <= 5 < len(b) + 5\n1 < a < 3 < print(0)\n3 > a == a")
+    assert_out_err(capsys, "True\nFalse\nFalse\n", "")
+    with pytest.raises(TypeError):
+        main(vm, "a = 1\na < 'b'")
+
+    # Fused with the jump in tests, like `while i < n`
+    source = "i = 0\nn = 10\nt = 0\nwhile i < n:\n    t += i\n    i += 1\nt"
+    assert "POP_JUMP_IF_NOT_LT" in opnames(source)
+    assert "COMPARE_OP" not in opnames(source)
+    for superinstructions in (True, False):
+        vm.run(compile_source(source, superinstructions=superinstructions))
+    assert_out_err(capsys, "45\n45\n", "")
+
+
+def test_boolop(capsys):
+    main(vm, "a = 0; b = 2; a and b; a or b; b and a; b or a; a or 0 or []; b and 3 and 4")
+    assert_out_err(capsys, "0\n2\n0\n2\n[]\n4\n", "")
+    # Short-circuits, without evaluating the rest
+    main(vm, "a = 0\na and print(1)\n1 or print(2)\nprint(3) or print(4)")
+    assert_out_err(capsys, "0\n1\n3\n4\n", "")
+
+    source = """a = 0
+b = 0
+for x in range(100):
+    if x % 2 and x % 3 or not x < 20:
+        a += 1
+    if not (x > 5 and x < 10) and not (x == 1 or x == 2):
+        b += 1
+    while a < 5 and not b:
+        a += 10
+print(a, b)
+"""
+    # Tests jump on each operand, rather than computing a bool
+    assert not {"JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP", "UNARY_NOT"} & set(opnames(source))
+    main(vm, source)
+    for slots in (False, True):
+        jit_vm = curvy.VirtualMachine(jit=True, slots=slots)
+        jit_vm.run(compile_source(source, slots=slots))
+        assert jit_vm.jit_report()["compiled"] == 1
+    assert_out_err(capsys, '87 94\n' * 3, "")
+
+
 def test_assignment(capsys):
     # Testing assignment
     main(vm, "a = 1;a")
@@ -183,13 +252,13 @@ def test_if(capsys):
     )
     assert_out_err(capsys, "1\n", "")
 
-#     main(vm,
-#     """"if(0):
-#     print(1)
-# else:
-#     print(2)"""
-#     )
-#     assert_out_err(capsys, "2\n", "")
+    main(vm,
+"""if(0):
+    print(1)
+else:
+    print(2)"""
+    )
+    assert_out_err(capsys, "2\n", "")
 
 def test_while(capsys):
     main(vm,
@@ -207,6 +276,20 @@ for x in a:
 )
     assert_out_err(capsys, "1\n2\n3\n4\n", "")
 
+def test_for_range(capsys):
+    assert "FOR_RANGE" in opnames("for x in range(3):\n    x")
+    assert "FOR_RANGE" not in opnames("for x in range(0, 6, 2):\n    x")
+
+    main(vm, "for x in range(3):\n    x\nfor x in range(4, 6):\n    x\nfor x in range(2, 1):\n    x")
+    assert_out_err(capsys, "0\n1\n2\n4\n5\n", "")
+
+    main(vm, "a = 0\nfor x in range(0, 6, 2):\n    a += x\na")
+    assert_out_err(capsys, "6\n", "")
+
+    # Rebinding range falls back to iterating over whatever it returns
+    main(vm, "range = sorted\nfor x in range([3, 1, 2]):\n    x\ndel range")
+    assert_out_err(capsys, "1\n2\n3\n", "")
+
 def test_pass(capsys):
     main(vm, "pass")
     assert_out_err(capsys, "", "")
@@ -215,3 +298,543 @@ def test_extended_arg(capsys):
     input_list = [x for x in range(312)]
     main(vm, f"a = {input_list}; a")
     assert_out_err(capsys, f"{input_list}\n", "")
+
+    # Jumps over and back past more than 255 instructions
+    main(vm, f"a = {input_list}\nfor x in a:\n    b = {input_list}\n    b[x]\n")
+    assert_out_err(capsys, "".join(f"{x}\n" for x in input_list), "")
+
+    main(vm, f"a = 0\nif a:\n    {input_list}\nelse:\n    {input_list[::-1]}")
+    assert_out_err(capsys, f"{input_list[::-1]}\n", "")
+
+def test_decode(capsys):
+    compiler = Compiler()
+    compiler.visit([ast.parse("a = 3\nwhile a:\n    a -= 1\na")])
+    bytecode = compiler.build()
+
+    decoded = bytecode.decode()
+    # Decoded once and cached on the code object
+    assert bytecode.decode() is decoded
+    assert OPCODES["EXTENDED_ARG"] not in [opcode for opcode, oparg in decoded]
+
+    vm.run(bytecode)
+    vm.run(bytecode)
+    assert_out_err(capsys, "0\n0\n", "")
+
+def test_compile_cache(capsys):
+    cache = CompileCache(maxsize=2)
+    main(vm, "a = 1; a + 1", cache=cache)
+    main(vm, "a = 1; a + 1", cache=cache)
+    assert_out_err(capsys, "2\n2\n", "")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    main(vm, "2", cache=cache)
+    main(vm, "3", cache=cache)
+    assert_out_err(capsys, "2\n3\n", "")
+    # The first snippet was the least recently used
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+    cache.clear()
+    assert cache.stats() == {
+        "size": 0, "maxsize": 2, "hits": 0, "misses": 0, "evictions": 0
+    }
+
+def test_curvyc(capsys, tmp_path):
+    path = str(tmp_path / "loop.curvyc")
+    save_code(compile_source("a = 3\nwhile a:\n    a -= 1\nprint(a, 'done', 1.5)"), path)
+
+    bytecode = load_code(path)
+    assert isinstance(bytecode.code, memoryview)
+    assert bytecode.lines() == [1, 1, 2, 2, 3, 2, 4, 4, 4, 4, 4]
+    vm.run(bytecode)
+    run_file(vm, path)
+    assert_out_err(capsys, "0 done 1.5\n0 done 1.5\n", "")
+
+    (tmp_path / "bad.curvyc").write_bytes(b"nope")
+    with pytest.raises(ValueError):
+        load_code(str(tmp_path / "bad.curvyc"))
+    # Sections cut short by a truncated file
+    with open(path, "rb") as file:
+        data = file.read()
+    (tmp_path / "short.curvyc").write_bytes(data[:-1])
+    with pytest.raises(ValueError, match="truncated"):
+        load_code(str(tmp_path / "short.curvyc"))
+
+def opnames(source):
+    return [OPNAMES[opcode] for opcode, oparg in compile_source(source).decode()]
+
+def test_constant_folding(capsys):
+    main(vm, "-1; not 0; ~5; +2")
+    assert_out_err(capsys, "-1\nTrue\n-6\n2\n", "")
+    assert opnames("-1; not 0; ~5") == ["LOAD_CONST", "PRINT_EXPR"] * 3
+
+    # Dead branches are removed
+    assert "JUMP_IF_FALSE" not in opnames("if 0:\n    a = 1\nelse:\n    a = 2")
+    main(vm, "a = 1 if not 1 else 2; a")
+    assert_out_err(capsys, "2\n", "")
+    assert opnames("while 0:\n    a = 1") == []
+
+    # `while 1` has no test
+    with pytest.raises(ZeroDivisionError):
+        main(vm, "a = 3\nwhile 1:\n    a -= 1\n    1 // a")
+    assert_out_err(capsys, "0\n1\n", "")
+    assert "JUMP_IF_FALSE" not in opnames("while 1:\n    pass")
+
+    # Folding never raises, errors happen when the code runs
+    with pytest.raises(ZeroDivisionError):
+        main(vm, "1 / 0")
+    assert opnames("2 ** 100000") == ["LOAD_CONST", "LOAD_CONST", "BINARY_POW", "PRINT_EXPR"]
+
+    # Equal constants that print differently don't share a slot
+    main(vm, "a = 0.0\nb = -0.0\nprint(a, b, 0.0 * -1, (1,), (1.0,), 1 == 1.0)")
+    assert_out_err(capsys, "0.0 -0.0 -0.0 (1,) (1.0,) True\n", "")
+
+def test_peephole(capsys):
+    compiler = Compiler()
+    compiler.visit([ast.parse("a = 0\nwhile 1:\n    a = 1 // a\nprint(a)")])
+    bytecode = compiler.build()
+    # Everything after the infinite loop is unreachable
+    assert compiler.peephole_removed == 4
+    assert [OPNAMES[opcode] for opcode, oparg in bytecode.decode()] == [
+        "LOAD_CONST", "STORE_NAME", "LOAD_CONST", "LOAD_NAME", "BINARY_FLOORDIV",
+        "STORE_NAME", "JUMP",
+    ]
+
+    # A stored name loaded straight back is duplicated instead
+    assert opnames("a = 1; a")[:3] == ["LOAD_CONST", "DUP_TOP", "STORE_NAME"]
+
+    # Jumps to jumps are threaded
+    decoded = compile_source(
+        "for x in [1, 2]:\n    if x:\n        print(x)\n    else:\n        print(0)"
+    ).decode()
+    jumps = [oparg for opcode, oparg in decoded if OPNAMES[opcode] == "JUMP"]
+    assert jumps == [decoded.index((OPCODES["FOR_ITER"], len(decoded) - 1))] * 2
+
+    main(vm, "a = 1; b = a; b\nfor x in [1, 2]:\n    if x - 1:\n        x\n    else:\n        0")
+    assert_out_err(capsys, "1\n0\n2\n", "")
+
+def test_stacksize(capsys):
+    assert compile_source("a = 1").stacksize == 1
+    assert compile_source("a = 1; print(a, (a, 2), [a, a + 1])").stacksize == 6
+
+    main(vm, "a = 1\nfor x in [a, 2]:\n    print(x, max(a, x, 0))\n{'a': a, 'b': 2}")
+    assert_out_err(capsys, "1 1\n2 2\n{'a': 1, 'b': 2}\n", "")
+
+def test_slots(capsys):
+    slot_vm = VirtualMachine(slots=True)
+    main(slot_vm, "a = 3\nwhile a:\n    a -= 1\nb = [a, 2]\nprint(b)")
+    assert_out_err(capsys, "[0, 2]\n", "")
+    decoded = compile_source("a = 1\nprint(a)", slots=True).decode()
+    assert not [opcode for opcode, oparg in decoded if "NAME" in OPNAMES[opcode]]
+    assert slot_vm.globals == {"a": 0, "b": [0, 2]}
+
+    # Names persist between runs through `globals`
+    main(slot_vm, "b; len(b)")
+    assert_out_err(capsys, "[0, 2]\n2\n", "")
+
+    with pytest.raises(NameError):
+        main(slot_vm, "del a; a")
+    assert "a" not in slot_vm.globals
+    with pytest.raises(NameError):
+        main(slot_vm, "del c")
+
+    # Code whose only slot accesses are fused into superinstructions
+    main(slot_vm, "x = 1")
+    main(slot_vm, "x += 1")
+    main(slot_vm, "print(x + 1)")
+    main(slot_vm, "print(x, x)")
+    assert_out_err(capsys, "3\n2 2\n", "")
+    assert slot_vm.globals["x"] == 2
+
+def test_instrumentation(capsys):
+    source = "a = 3\nwhile a:\n    a -= 1\nprint(a)"
+    plain_vm = VirtualMachine()
+    main(plain_vm, source)
+    assert plain_vm.counts == []
+
+    counted_vm = VirtualMachine(instrument=True, engine="loop")
+    main(counted_vm, source)
+    report = counted_vm.instrumentation_report()
+    assert report["opcodes"]["INPLACE_OP_NAME_CONST"] == {"count": 3}
+    assert report["opcodes"]["POP_JUMP_IF_FALSE"] == {"count": 4}
+    assert report["offsets"][0]["count"] == 4
+    assert report["instructions"] == sum(
+        stats["count"] for stats in report["opcodes"].values()
+    )
+
+    timed_vm = VirtualMachine(timing=True, engine="loop")
+    main(timed_vm, source)
+    report = json.loads(json.dumps(timed_vm.instrumentation_report()))
+    assert report["opcodes"]["INPLACE_OP_NAME_CONST"]["count"] == 3
+    assert report["opcodes"]["INPLACE_OP_NAME_CONST"]["time_ns"] >= 0
+    assert_out_err(capsys, "0\n0\n0\n", "")
+
+def test_adaptive(capsys):
+    adaptive_vm = VirtualMachine(adaptive=True, engine="loop")
+    bytecode = compile_source(
+        "a = 20\nwhile a:\n    a -= 1\n    b += 0.5\nprint(a, b)", superinstructions=False
+    )
+    adaptive_vm.globals["b"] = 0.0
+    adaptive_vm.run(bytecode)
+    assert_out_err(capsys, "0 10.0\n", "")
+    assert {"BINARY_SUB_INT", "BINARY_ADD_FLOAT"} <= {
+        OPNAMES[opcode] for opcode, oparg in bytecode.decode()
+    }
+    report = adaptive_vm.specialization_report()
+    assert report["specializations"] == 2
+    assert report["hits"] > report["generic"]
+    assert 0 < report["hit_rate"] < 1
+
+    # Changing operand types deoptimizes back to the generic opcode
+    adaptive_vm.globals["b"] = 1
+    adaptive_vm.run(bytecode)
+    assert_out_err(capsys, "0 11.0\n", "")
+    assert adaptive_vm.specialization_report()["misses"] == 1
+
+    # Specialized code still runs on a VM that isn't adaptive
+    vm.globals["b"] = 0.0
+    vm.run(bytecode)
+    assert_out_err(capsys, "0 10.0\n", "")
+
+def test_superinstructions(capsys):
+    source = "a = 5\nb = 0\nwhile a:\n    b = b + a * 2\n    a -= 1\n    b = b - 1 + a\nprint(a, b)"
+    assert opnames(source).count("INPLACE_OP_NAME_CONST") == 1
+    assert opnames(source).count("BINARY_OP_NAME_CONST") == 1
+    assert "LOAD_NAME_NAME" in opnames(source)
+    assert "POP_JUMP_IF_FALSE" in opnames(source)
+    assert "POP_TOP" not in opnames(source)
+
+    plain = [
+        OPNAMES[opcode]
+        for opcode, oparg in compile_source(source, superinstructions=False).decode()
+    ]
+    assert not {"INPLACE_OP_NAME_CONST", "LOAD_NAME_NAME"} & set(plain)
+    # Tests pop their value without superinstructions too
+    assert "POP_JUMP_IF_FALSE" in plain and "POP_TOP" not in plain
+
+    main(vm, source)
+    main(VirtualMachine(slots=True), source)
+    assert_out_err(capsys, "0 35\n" * 2, "")
+    with pytest.raises(NameError):
+        main(vm, "del a\na -= 1")
+
+def test_run_batch(capsys):
+    scripts = [
+        "a = 1\nprint(a)",
+        "a",
+        compile_source("for x in range(3):\n    x"),
+        "1 +",
+        "print('bye')\nexit()",
+    ] + [f"{x} * 2" for x in range(20)]
+    for precompile in (True, False):
+        results = run_batch(scripts, workers=2, chunksize=4, precompile=precompile)
+        assert results[0] == ("1\n", None)
+        # Globals don't leak from one script to the next
+        assert results[1].output == ""
+        assert isinstance(results[1].error, NameError)
+        assert results[2] == ("0\n1\n2\n", None)
+        assert isinstance(results[3].error, SyntaxError)
+        assert results[4].output == "bye\n"
+        assert isinstance(results[4].error, SystemExit)
+        assert [result.output for result in results[5:]] == [f"{x * 2}\n" for x in range(20)]
+
+def test_time_slicing(capsys):
+    stepped_vm = VirtualMachine()
+    steps = stepped_vm.run_steps(compile_source("a = 0\nfor x in range(100):\n    a += x\na"), 10)
+    assert len(list(steps)) > 10
+    assert_out_err(capsys, "4950\n", "")
+
+    jobs = [
+        (VirtualMachine(), compile_source("for x in range(3):\n    print('a', x)")),
+        (VirtualMachine(), compile_source("1 / 0")),
+        (VirtualMachine(slots=True), compile_source("for x in range(3):\n    print('b', x)", slots=True)),
+    ]
+    errors = asyncio.run(run_interleaved(jobs, count=4))
+    assert errors[0] is None and errors[2] is None
+    assert isinstance(errors[1], ZeroDivisionError)
+    # The two loops take turns
+    assert_out_err(capsys, "a 0\nb 0\na 1\nb 1\na 2\nb 2\n", "")
+    assert jobs[2][0].globals["x"] == 2
+
+    # Runs stopped between steps are finished too, storing variable slots back
+    slot_vm = VirtualMachine(slots=True)
+    bytecode = compile_source("a = 0\nwhile 1:\n    a += 1", slots=True)
+    steps = slot_vm.run_steps(bytecode, 100)
+    next(steps)
+    steps.close()
+    assert slot_vm.frames == {} and slot_vm.globals["a"] > 0
+
+    async def cancel():
+        task = asyncio.ensure_future(slot_vm.run_async(bytecode, 100))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    slot_vm.globals.clear()
+    asyncio.run(cancel())
+    assert slot_vm.frames == {} and slot_vm.globals["a"] > 0
+
+    jit_vm = curvy.VirtualMachine(jit=True)
+    with pytest.raises(ValueError):
+        next(jit_vm.run_steps(bytecode))
+    with pytest.raises(ValueError):
+        asyncio.run(jit_vm.run_async(bytecode))
+
+
+def test_limits(capsys):
+    limited_vm = VirtualMachine(max_instructions=10000)
+    with pytest.raises(ResourceLimitExceeded) as info:
+        limited_vm.run(compile_source("while 1:\n    pass"))
+    assert info.value.pc is not None and "instruction limit" in str(info.value)
+    # A loop whose only back edge is a conditional jump, threaded to the loop's start
+    with pytest.raises(ResourceLimitExceeded, match="instruction limit"):
+        limited_vm.run(compile_source("a = 0\nwhile 1:\n    if a:\n        b = 1"))
+    limited_vm.run(compile_source("a = 0\nfor x in range(100):\n    a += x\na"))
+    assert_out_err(capsys, "4950\n", "")
+
+    with pytest.raises(ResourceLimitExceeded, match="time limit"):
+        VirtualMachine(timeout=0.01).run(compile_source("while 1:\n    pass"))
+
+    sized_vm = VirtualMachine(max_size=1000)
+    for source in ("[0] * 10 ** 9", "list(range(10 ** 9))", "a = [0]\na *= 10 ** 9", "'ab' * 600"):
+        for superinstructions in (True, False):
+            with pytest.raises(ResourceLimitExceeded, match="size limit"):
+                sized_vm.run(compile_source(source, superinstructions=superinstructions))
+    with pytest.raises(ResourceLimitExceeded, match="size limit"):
+        sized_vm.run(compile_source(f"a = {list(range(2000))}", peephole=False))
+    sized_vm.run(compile_source("a = [1, 2] * 3 + [4]\nlen(a)"))
+    assert_out_err(capsys, "7\n", "")
+
+    adaptive_vm = VirtualMachine(adaptive=True, max_size=100, engine="loop")
+    adaptive_vm.run(compile_source("a = 0\nfor x in range(20):\n    a = a + x\na", superinstructions=False))
+    with pytest.raises(ResourceLimitExceeded):
+        adaptive_vm.run(compile_source("[0] * 200", superinstructions=False))
+    assert_out_err(capsys, "190\n", "")
+
+
+def test_threads(capsys):
+    bytecode = compile_source("a = 0\nfor x in range(n):\n    a += x\nb = 1 / a")
+    namespaces = [{"n": n} for n in range(1, 9)]
+    errors = run_threaded(vm, bytecode, namespaces)
+    assert isinstance(errors[0], ZeroDivisionError)
+    assert errors[1:] == [None] * 7
+    for n, namespace in enumerate(namespaces, 1):
+        assert namespace["a"] == n * (n - 1) // 2
+    assert "a" not in vm.globals and vm.frames == {}
+
+    threaded_vm = VirtualMachine(slots=True, adaptive=True, engine="loop")
+    threaded_vm.globals["n"] = 100
+    bytecode = compile_source("a = 0\nfor x in range(n):\n    a += x", slots=True)
+    assert run_threaded(threaded_vm, bytecode, [None] * 4) == [None] * 4
+    assert threaded_vm.globals["a"] == 4950
+    assert_out_err(capsys, "", "")
+
+
+def test_snapshot(capsys):
+    warm_vm = VirtualMachine()
+    warm_vm.run(compile_source("table = list(range(10000))\nn = 0"))
+    snapshot = warm_vm.snapshot()
+    assert isinstance(snapshot, Snapshot)
+
+    forked_vm = snapshot.fork()
+    forked_vm.run(compile_source("n += table[-1]\ntable = [n]\nn"))
+    forked_vm.run(compile_source("table"))
+    assert_out_err(capsys, "9999\n[9999]\n", "")
+    assert snapshot.globals["n"] == 0
+
+    # Each fork has its own copy of the containers, changed in place or not
+    source = "getattr(table, 'append')(n)\ngetattr(nested[0], 'append')(n)\nn = 1"
+    warm_vm.run(compile_source("nested = [[1], (2,)]\nkeys = {'a': 1}"))
+    snapshot = warm_vm.snapshot()
+    forks = [snapshot.fork(), snapshot.fork(slots=True)]
+    forks[0].run(compile_source(source))
+    forks[1].run(compile_source("getattr(keys, 'clear')()\nlen(table)"))
+    warm_vm.run(compile_source(source))
+    assert_out_err(capsys, "10000\n", "")
+    assert len(forks[0].globals["table"]) == 10001
+    assert forks[1].globals["nested"] == [[1], (2,)] and snapshot.restore()["keys"] == {"a": 1}
+    assert snapshot.restore()["nested"] == [[1], (2,)] and len(snapshot.globals["table"]) == 10000
+
+    scripts = [f"n += table[{x}]\nprint(n)" for x in range(5)]
+    results = run_batch(scripts, workers=2, snapshot=snapshot)
+    assert [result.output for result in results] == [f"{x}\n" for x in range(5)]
+
+
+def test_deep_nesting(capsys):
+    # Deeper than the recursion limit, and than `ast.parse` can handle
+    expr = ast.Name("a", ast.Load())
+    folded = ast.Constant(0)
+    for x in range(20000):
+        expr = ast.BinOp(expr, ast.Add(), ast.Constant(1))
+        if x % 2:
+            folded = ast.UnaryOp(ast.USub(), folded)
+        else:
+            folded = ast.BinOp(ast.Constant(1), ast.Add(), folded)
+    tree = ast.Module([ast.Expr(expr), ast.Expr(folded)], [])
+    tree = Optimizer().visit(tree)
+    assert isinstance(tree.body[1].value, ast.Constant)
+    compiler = Compiler()
+    compiler.visit([tree])
+    vm.globals["a"] = 1
+    vm.run(compiler.build())
+    assert_out_err(capsys, "20001\n0\n", "")
+
+    source = "a = 2\n" + " + ".join(["a * 3"] * 500) + "\nif a:\n    a -= 1\na"
+    main(vm, source)
+    assert_out_err(capsys, "3000\n1\n", "")
+
+    # Loop invariant code motion copies the test of a loop to check it runs
+    test = ast.Name("a", ast.Load())
+    for x in range(20000):
+        test = ast.BinOp(test, ast.Add(), ast.Name("a", ast.Load()))
+    body = ast.parse("b = c * 2 + 1\na += 1").body
+    loop = ast.While(ast.Compare(test, [ast.Lt()], [ast.Constant(3)]), body, [])
+    tree = ast.Module(ast.parse("a = 0\nc = 3").body + [loop], [])
+    optimizer = Optimizer(licm=True)
+    tree = optimizer.optimize(tree)
+    assert optimizer.hoisted == 1
+    compiler = Compiler()
+    compiler.visit([tree])
+    vm.run(compiler.build())
+    assert (vm.globals["a"], vm.globals["b"]) == (1, 7)
+
+
+def test_closure_engine(capsys):
+    closure_vm = curvy.VirtualMachine(engine="closure")
+    bytecode = compile_source("a = 100000\nwhile a:\n    a -= 1\na")
+    closure_vm.run(bytecode)
+    ops = closure_vm.closures[bytecode]
+    closure_vm.run(bytecode)
+    # Translated once, and long loops don't recurse
+    assert closure_vm.closures[bytecode] is ops and len(ops) == len(bytecode.decode()) + 1
+    assert_out_err(capsys, "0\n0\n", "")
+
+    with pytest.raises(ValueError):
+        curvy.VirtualMachine(engine="closure", instrument=True)
+    with pytest.raises(ValueError):
+        curvy.VirtualMachine(engine="threaded")
+
+
+def test_jit(capsys):
+    jit_vm = curvy.VirtualMachine(jit=True)
+    bytecode = compile_source("a = 1000\nt = 0\nwhile a:\n    a -= 1\n    t = t + len([a, t])\nt")
+    jit_vm.run(bytecode)
+    report = jit_vm.jit_report()
+    assert report["compiled"] == 1 and report["runs"] == 1 and report["time"] > 0
+    (loop,) = jit_vm.jit_loops[bytecode].values()
+    assert "b_len" in loop.source
+    # A variable shadowing a builtin the loop was compiled with exits to the interpreter
+    jit_vm.globals["len"] = lambda items: 1
+    jit_vm.run(bytecode)
+    assert jit_vm.jit_report()["compiled"] == 1
+    assert jit_vm.jit_report()["guard_exits"] > 0
+    assert_out_err(capsys, "2000\n1000\n", "")
+
+    # Nested loops, for loops, slots, and an error raised in a compiled loop
+    source = "b = 0\nfor x in range(100):\n    c = 100\n    while c:\n        c -= 1\n        b += x % 3\nb\n"
+    for slots in (False, True):
+        jit_vm = curvy.VirtualMachine(jit=True, slots=slots)
+        jit_vm.run(compile_source(source, slots=slots))
+        assert jit_vm.jit_report()["compiled"] == 2
+        jit_vm.globals["a"] = 200
+        with pytest.raises(ZeroDivisionError):
+            jit_vm.run(compile_source("while a:\n    a -= 1\n    b = 1 / (a - 20)", slots=slots))
+        assert jit_vm.globals["a"] == 20
+    assert_out_err(capsys, "9900\n9900\n", "")
+
+    with pytest.raises(ValueError):
+        curvy.VirtualMachine(jit=True, max_instructions=100)
+
+
+def test_licm_cse(capsys):
+    source = """n = 3
+t = 0
+for x in range(n * 2):
+    a = 4
+    while a:
+        t = (n * 4 + 1) * x + (n * 4 + 1) + t
+        a -= 1
+print(t, ((n + 1) * (n + 1) + n) * ((n + 1) * (n + 1) + n))
+"""
+    optimizer = Optimizer(licm=True, cse=True)
+    tree = optimizer.optimize(ast.parse(source))
+    assert set(optimizer.timings) == {"fold", "licm", "cse"}
+    assert optimizer.hoisted == 1 and optimizer.reused == 2
+    # Hoisted out of the inner loop, which is only entered if it runs
+    assert "if a:\n        .licm0 = (.cse1 := (n * 4 + 1)) * x + .cse1\n" in ast.unparse(tree)
+    assert "t = .licm0 + t" in ast.unparse(tree)
+    assert "(.cse2 := ((n + 1) * (n + 1) + n)) * .cse2" in ast.unparse(tree)
+    for slots in (False, True):
+        bytecode = compile_source(source, slots=slots, licm=True, cse=True)
+        optimized_vm = VirtualMachine(slots=slots)
+        optimized_vm.run(bytecode)
+        # The variables the passes add don't outlive their statement or loop
+        assert sorted(optimized_vm.globals) == ["a", "n", "t", "x"]
+    assert_out_err(capsys, "1092 361\n1092 361\n", "")
+
+    # Only expressions evaluated every iteration are hoisted, and only if the loop runs
+    source = "a = 0\nb = 0\nwhile a:\n    c = 1 / b\nfor x in range(b):\n    c = 1 / b\nb"
+    optimizer = Optimizer(licm=True)
+    optimizer.optimize(ast.parse(source))
+    assert optimizer.hoisted == 2
+    vm.run(compile_source(source, licm=True))
+    # ... and nothing that could raise or have an effect runs before them
+    source = "i = 0\nb = 0\nwhile i < 3:\n    print(i)\n    y = 10 / b\n    i += 1"
+    source += "\nfor x in range(2):\n    c = b + x\n    y = 10 / b"
+    optimizer = Optimizer(licm=True)
+    optimizer.optimize(ast.parse(source))
+    assert optimizer.hoisted == 0
+    with pytest.raises(ZeroDivisionError):
+        vm.run(compile_source(source, licm=True))
+    assert_out_err(capsys, "0\n0\n", "")
+    # Names that might be unbound could raise NameError first
+    source = "i = 0\nb = 0\nwhile i < 3:\n    a = undefined\n    y = 10 / b\n    i += 1"
+    with pytest.raises(NameError):
+        vm.run(compile_source(source, licm=True))
+    source = "b = 2\nfor x in range(2):\n    a = x\n    c = a\n    y = 10 / b"
+    optimizer = Optimizer(licm=True)
+    optimizer.optimize(ast.parse(source))
+    assert optimizer.hoisted == 1
+    source = "a = 2\nb = 0\nwhile a:\n    d = b * 2 + b * 2\n    c = a if a else 1 / b\n    a -= 1\nc"
+    optimizer = Optimizer(licm=True, cse=True)
+    tree = optimizer.optimize(ast.parse(source))
+    assert optimizer.hoisted == 1 and optimizer.reused == 0
+    assert "a if a else 1 / b" in ast.unparse(tree)
+    vm.run(compile_source(source, licm=True, cse=True))
+    assert_out_err(capsys, "1\n", "")
+    assert Optimizer(fold=False).optimize(ast.parse("1 + 2")).body[0].value.op
+
+    # Names assigned with `:=` change within the statement
+    source = "a = 1\nb = 2\nx = (a + b) * 3 + (a := 5) + (a + b) * 3\nx"
+    main(vm, source)
+    vm.run(compile_source(source, cse=True))
+    assert_out_err(capsys, "35\n35\n", "")
+
+
+def test_profiler(capsys, engine):
+    source = "a = 0\nfor x in range(100000):\n    a += x * x\n" + "\n" * 300 + "a\n"
+    bytecode = compile_source(source)
+    lines = bytecode.lines()
+    assert lines[0] == 1 and lines[-1] == 304
+    assert Compiler.encode_lines(lines) == bytecode.linetable
+    # Changes of more than a byte take several pairs
+    lines = [3, 300, 1, 0] + [7] * 600
+    linetable = Compiler.encode_lines(lines)
+    assert curvy.Code((), (), bytes(2 * len(lines)), 0, linetable).lines() == lines
+
+    if engine == "closure":
+        with pytest.raises(ValueError):
+            curvy.Profiler(vm)
+        return
+    profiler = curvy.Profiler(vm, interval=0.0005)
+    with pytest.raises(RuntimeError):
+        profiler.stop()
+    with profiler:
+        vm.run(bytecode)
+    assert_out_err(capsys, f"{sum(x * x for x in range(100000))}\n", "")
+    counts = profiler.line_counts()
+    assert counts and {line for line, opname in counts} <= {1, 2, 3, 304}
+    assert max(counts, key=counts.get)[0] in (2, 3)
+    assert profiler.collapsed("loop").startswith("loop;line ")
+    assert ";BINARY_" in profiler.collapsed(opcodes=True)